@@ -0,0 +1,98 @@
+#!/usr/bin/python
+"""
+Benchmark for the windows-1252 remapping feedparser applies to every unicode
+value it pops off the element stack.
+
+The old implementation rebuilt each value one character at a time (with a
+fresh _cp1252.keys() list per character); it is kept here as old_remap so we
+can check that the translate table gives identical output on a large mixed
+corpus and see how much faster it is.
+
+usage: python benchmarks/bench_cp1252.py [values] [repeat]
+"""
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "smartrssparser"))
+import feedparser
+
+
+def old_remap(output):
+    return u''.join([c in feedparser._cp1252.keys() and
+                     feedparser._cp1252[c] or c for c in output])
+
+
+def new_remap(output):
+    if feedparser._c1_controls.search(output):
+        output = output.translate(feedparser._cp1252_table)
+    return output
+
+
+def make_corpus(count, seed=1):
+    """
+    Builds a list of unicode values shaped like what feeds give us: short
+    titles, long html content, latin-1 and cjk text, and text that went
+    through a cp1252/latin-1 mixup and is full of C1 control characters
+    """
+    rng = random.Random(seed)
+    ascii_words = [u"feed", u"story", u"<p>", u"</p>", u"<a href=\"/x\">",
+                   u"</a>", u"the", u"news", u"&amp;", u"today"]
+    latin1_words = [u"caf\xe9", u"na\xefve", u"\xfcber", u"se\xf1or"]
+    cjk_words = [u"\u65b0\u805e", u"\u4eca\u65e5",
+                 u"\u30cb\u30e5\u30fc\u30b9"]
+    c1_words = [unichr(c) for c in range(0x80, 0xa0)] + [u"it\x92s",
+                u"\x93quoted\x94", u"\x80 5"]
+    kinds = [(ascii_words, 0.5), (latin1_words, 0.2), (cjk_words, 0.1),
+             (c1_words, 0.2)]
+    corpus = []
+    for i in range(count):
+        length = rng.choice([8, 40, 400, 4000])
+        words = []
+        for kind in kinds:
+            if rng.random() < kind[1]:
+                words.extend(kind[0])
+        if not words:
+            words = ascii_words
+        corpus.append(u" ".join([rng.choice(words) for j in range(length)]))
+    return corpus
+
+
+def best_of(func, corpus, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for value in corpus:
+            func(value)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main(argv):
+    count = len(argv) > 1 and int(argv[1]) or 2000
+    repeat = len(argv) > 2 and int(argv[2]) or 3
+    corpus = make_corpus(count)
+    characters = sum([len(value) for value in corpus])
+
+    mismatches = [value for value in corpus
+                  if old_remap(value) != new_remap(value)]
+    if mismatches:
+        print "MISMATCH on %d of %d values" % (len(mismatches), len(corpus))
+        return 1
+
+    old = best_of(old_remap, corpus, repeat)
+    new = best_of(new_remap, corpus, repeat)
+    print "%d values, %d characters, identical output" % (len(corpus),
+                                                          characters)
+    print "join per character: %8.3f s" % old
+    print "translate table:    %8.3f s  (%.0fx)" % (new, old / max(new, 1e-9))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
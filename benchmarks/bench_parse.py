@@ -0,0 +1,255 @@
+#!/usr/bin/python
+"""
+Benchmark suite for feedparser.parse and smart_parse on the synthetic feeds
+built by corpus.py: every format, 5 to 5000 entries, html heavy content,
+other encodings and malformed feeds that need the loose parser.
+
+Each case runs in a forked child so its peak memory is its own and it can't
+warm caches for the next case. For every case and function we report the
+latency of the first (cold) parse, percentiles of the parses after it,
+throughput in entries and megabytes per second and peak memory. With
+--output the results are written as JSON along with the python version,
+platform and git revision, and --compare prints how a run compares to
+results saved from another build.
+
+smart_parse only takes http urls, so its feeds are served from a local
+SimpleHTTPServer and its times include the loopback request.
+
+usage: python benchmarks/bench_parse.py [--quick] [--repeat N]
+           [--filter TEXT] [--functions parse,smart_parse]
+           [--output results.json] [--compare old.json]
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import platform
+import resource
+import tempfile
+import subprocess
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "smartrssparser"))
+import feedparser
+import smartrssparser
+
+import corpus
+
+FUNCTIONS = ("parse", "smart_parse")
+
+# cases this big are parsed at most this many times
+BIG_CASE_ENTRIES = 5000
+BIG_CASE_REPEAT = 2
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+
+def measure(case, function, repeat, base_url):
+    """
+    Parses case repeat + 1 times with function and returns the results as
+    a dict, the first parse is reported separately as the cold one
+    """
+    data = case.data()
+    if function == "parse":
+        call = lambda: feedparser.parse(data)
+    else:
+        url = "%s/%s.xml" % (base_url, case.name)
+        call = lambda: smartrssparser.smart_parse(url)
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    for i in range(repeat + 1):
+        start = time.time()
+        result = call()
+        times.append(time.time() - start)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+
+    if function == "parse":
+        entries = len(result["entries"])
+        bozo = result.get("bozo", 0)
+    else:
+        entries = len(result["stories"])
+        bozo = result.get("bozo", 0)
+
+    cold, warm = times[0], times[1:]
+    mean = sum(warm) / len(warm)
+    return {
+        "case": case.name, "function": function, "format": case.format,
+        "entries": case.entries, "encoding": case.encoding,
+        "html": case.html, "malformed": case.malformed,
+        "bytes": len(data), "parsed_entries": entries, "bozo": bool(bozo),
+        "repeat": len(warm), "cold": cold, "mean": mean,
+        "p50": percentile(warm, 0.5), "p90": percentile(warm, 0.9),
+        "p99": percentile(warm, 0.99), "max": max(warm),
+        "entries_per_second": entries / max(mean, 1e-9),
+        "mb_per_second": len(data) / 1048576.0 / max(mean, 1e-9),
+        # ru_maxrss is in kilobytes on linux
+        "peak_memory_kb": peak,
+    }
+
+
+def measure_in_child(case, function, repeat, base_url):
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        try:
+            try:
+                output = json.dumps(measure(case, function, repeat, base_url))
+            except Exception, e:
+                output = json.dumps({"case": case.name, "function": function,
+                                     "error": repr(e)})
+            os.write(write_end, output)
+        finally:
+            os._exit(0)
+
+    os.close(write_end)
+    chunks = []
+    while True:
+        chunk = os.read(read_end, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    return json.loads("".join(chunks))
+
+
+def serve(cases):
+    """
+    Writes the cases to a temporary directory and serves it over http,
+    returns the base url, the directory and the server process
+    """
+    directory = tempfile.mkdtemp(prefix="bench_parse")
+    for case in cases:
+        open(os.path.join(directory, case.name + ".xml"), "wb").write(
+            case.data())
+
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+
+    devnull = open(os.devnull, "w")
+    server = subprocess.Popen([sys.executable, "-m", "SimpleHTTPServer",
+                               str(port)], cwd=directory, stdout=devnull,
+                              stderr=devnull)
+    for i in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), 1).close()
+            break
+        except socket.error:
+            time.sleep(0.05)
+    return "http://127.0.0.1:%d" % port, directory, server
+
+
+def git_revision():
+    try:
+        return subprocess.Popen(
+            ["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE,
+            stderr=open(os.devnull, "w"),
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+
+def print_results(results):
+    print "%-30s %-11s %7s %9s %9s %9s %9s %10s %7s %8s" % (
+        "case", "function", "entries", "cold ms", "p50 ms", "p90 ms",
+        "p99 ms", "entries/s", "MB/s", "peak MB")
+    for result in results:
+        if "error" in result:
+            print "%-30s %-11s %s" % (result["case"], result["function"],
+                                      result["error"])
+            continue
+        print "%-30s %-11s %7d %9.1f %9.1f %9.1f %9.1f %10.0f %7.2f %8.1f" % (
+            result["case"], result["function"], result["parsed_entries"],
+            result["cold"] * 1000, result["p50"] * 1000,
+            result["p90"] * 1000, result["p99"] * 1000,
+            result["entries_per_second"], result["mb_per_second"],
+            result["peak_memory_kb"] / 1024.0)
+
+
+def print_comparison(results, old_results):
+    old = dict([((result["case"], result["function"]), result)
+                for result in old_results if "error" not in result])
+    print
+    print "%-30s %-11s %12s %12s %8s" % ("case", "function", "old p50 ms",
+                                         "new p50 ms", "speedup")
+    for result in results:
+        key = (result["case"], result["function"])
+        if "error" in result or key not in old:
+            continue
+        print "%-30s %-11s %12.1f %12.1f %7.2fx" % (
+            result["case"], result["function"], old[key]["p50"] * 1000,
+            result["p50"] * 1000, old[key]["p50"] / max(result["p50"], 1e-9))
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage=__doc__.strip().split("usage: ")[1])
+    parser.add_option("--quick", action="store_true", default=False,
+                      help="leave out the feeds of 5000 entries")
+    parser.add_option("--repeat", type="int", default=5,
+                      help="warm parses per case (default 5)")
+    parser.add_option("--filter", default="",
+                      help="only run cases whose name contains this")
+    parser.add_option("--functions", default=",".join(FUNCTIONS),
+                      help="comma separated, parse and/or smart_parse")
+    parser.add_option("--output", help="write the results to this file")
+    parser.add_option("--compare", help="results file to compare with")
+    options, args = parser.parse_args(argv[1:])
+
+    functions = [function for function in options.functions.split(",")
+                 if function]
+    for function in functions:
+        if function not in FUNCTIONS:
+            parser.error("unknown function %s" % function)
+    cases = [case for case in corpus.make_corpus(quick=options.quick)
+             if options.filter in case.name]
+
+    base_url = directory = server = None
+    if "smart_parse" in functions:
+        base_url, directory, server = serve(cases)
+
+    results = []
+    try:
+        for case in cases:
+            repeat = options.repeat
+            if case.entries >= BIG_CASE_ENTRIES:
+                repeat = min(repeat, BIG_CASE_REPEAT)
+            for function in functions:
+                results.append(measure_in_child(case, function, max(repeat, 1),
+                                                base_url))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(directory)
+
+    print_results(results)
+    if options.compare:
+        print_comparison(results, json.load(open(options.compare))["results"])
+
+    if options.output:
+        json.dump({"python": platform.python_version(),
+                   "implementation": platform.python_implementation(),
+                   "platform": platform.platform(),
+                   "git_revision": git_revision(),
+                   "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                   "repeat": options.repeat,
+                   "results": results},
+                  open(options.output, "w"), indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
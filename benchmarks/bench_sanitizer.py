@@ -0,0 +1,150 @@
+#!/usr/bin/python
+"""
+Benchmark for the whitelist lookups and style sanitizing feedparser's
+_HTMLSanitizer does for every tag and attribute of htmlish content.
+
+The whitelists used to be lists, so every check was a linear scan, and
+sanitize_style compiled its regexes on every call. OldSanitizer puts lists
+and per call regexes back so we can check that the frozensets and
+precompiled regexes give identical output on a corpus of html heavy entries
+and see how much faster they are.
+
+usage: python benchmarks/bench_sanitizer.py [entries] [repeat]
+"""
+
+import os
+import re
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "smartrssparser"))
+import feedparser
+
+
+class OldSanitizer(feedparser._HTMLSanitizer):
+    acceptable_elements = list(feedparser._HTMLSanitizer.acceptable_elements)
+    acceptable_attributes = \
+        list(feedparser._HTMLSanitizer.acceptable_attributes)
+    unacceptable_elements_with_end_tag = \
+        list(feedparser._HTMLSanitizer.unacceptable_elements_with_end_tag)
+    acceptable_css_properties = \
+        list(feedparser._HTMLSanitizer.acceptable_css_properties)
+    acceptable_css_keywords = \
+        list(feedparser._HTMLSanitizer.acceptable_css_keywords)
+    mathml_elements = list(feedparser._HTMLSanitizer.mathml_elements)
+    mathml_attributes = list(feedparser._HTMLSanitizer.mathml_attributes)
+    svg_elements = list(feedparser._HTMLSanitizer.svg_elements)
+    svg_attributes = list(feedparser._HTMLSanitizer.svg_attributes)
+    acceptable_svg_properties = \
+        list(feedparser._HTMLSanitizer.acceptable_svg_properties)
+    elements_no_end_tag = list(feedparser._HTMLSanitizer.elements_no_end_tag)
+
+    def sanitize_style(self, style):
+        style = re.compile('url\s*\(\s*[^\s)]+?\s*\)\s*').sub(' ', style)
+        if not re.match("""^([:,;#%.\sa-zA-Z0-9!]|\w-\w|'[\s\w]+'|"[\s\w]+"|\([\d,\s]+\))*$""", style):
+            return ''
+        if re.sub("\s*[-\w]+\s*:\s*[^:;]*;?", '', style).strip():
+            return ''
+        clean = []
+        for prop, value in re.findall("([-\w]+)\s*:\s*([^:;]*)", style):
+            if not value:
+                continue
+            if prop.lower() in self.acceptable_css_properties:
+                clean.append(prop + ': ' + value + ';')
+            elif prop.split('-')[0].lower() in ['background', 'border',
+                                                'margin', 'padding']:
+                for keyword in value.split():
+                    if not keyword in self.acceptable_css_keywords and \
+                            not self.valid_css_values.match(keyword):
+                        break
+                else:
+                    clean.append(prop + ': ' + value + ';')
+            elif self.svgOK and prop.lower() in self.acceptable_svg_properties:
+                clean.append(prop + ': ' + value + ';')
+        return ' '.join(clean)
+
+
+def sanitize(cls, html):
+    p = cls('utf-8', 'text/html')
+    p.feed(html)
+    return p.output()
+
+
+def make_corpus(count, seed=1):
+    """
+    Builds a list of html entries like the ones blogs and news sites send:
+    paragraphs with links and images, inline styles, tables, the odd
+    script or iframe, and some inline svg and mathml
+    """
+    rng = random.Random(seed)
+    pieces = [
+        '<p class="intro" id="p%(n)d">Some text for story %(n)d with '
+        '<a href="/story/%(n)d" title="Story" rel="bookmark">a link</a> '
+        'and <em>emphasis</em>.</p>',
+        '<img src="/img/%(n)d.jpg" alt="photo" width="300" height="200" '
+        'border="0" onclick="steal()" />',
+        '<div style="color: red; background: white url(x.png); '
+        'margin: 0 auto; font-weight: bold">styled</div>',
+        '<span style="position: absolute; border: 1px solid #ccc">box</span>',
+        '<table border="1" cellpadding="2"><tr><th scope="col">a</th>'
+        '<td align="left" valign="top">%(n)d</td></tr></table>',
+        '<script type="text/javascript">document.write("%(n)d")</script>',
+        '<iframe src="http://ads.example.com/%(n)d"></iframe>',
+        '<ul><li>one</li><li>two &amp; three</li></ul><br/>',
+        '<blockquote cite="http://example.com/q">quoted <b>text</b>'
+        '</blockquote>',
+        '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 10 10">'
+        '<linearGradient id="g%(n)d"><stop offset="0" /></linearGradient>'
+        '<circle cx="5" cy="5" r="4" style="fill: red; stroke: blue" />'
+        '</svg>',
+        '<math xmlns="http://www.w3.org/1998/Math/MathML"><mrow><mi>x</mi>'
+        '<mo>=</mo><mn>%(n)d</mn></mrow></math>',
+        '<!-- a comment -->',
+    ]
+    corpus = []
+    for n in range(count):
+        length = rng.choice([5, 20, 80])
+        corpus.append(''.join([rng.choice(pieces) % {'n': n}
+                               for i in range(length)]))
+    return corpus
+
+
+def best_of(cls, corpus, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for html in corpus:
+            sanitize(cls, html)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main(argv):
+    count = len(argv) > 1 and int(argv[1]) or 300
+    repeat = len(argv) > 2 and int(argv[2]) or 3
+    corpus = make_corpus(count)
+    characters = sum([len(html) for html in corpus])
+
+    mismatches = [html for html in corpus
+                  if sanitize(OldSanitizer, html) !=
+                  sanitize(feedparser._HTMLSanitizer, html)]
+    if mismatches:
+        print "MISMATCH on %d of %d entries" % (len(mismatches), len(corpus))
+        return 1
+
+    old = best_of(OldSanitizer, corpus, repeat)
+    new = best_of(feedparser._HTMLSanitizer, corpus, repeat)
+    print "%d entries, %d characters, identical output" % (len(corpus),
+                                                           characters)
+    print "lists, per call regexes:      %8.3f s" % old
+    print "frozensets, compiled regexes: %8.3f s  (%.1fx)" % (
+        new, old / max(new, 1e-9))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,251 @@
+#!/usr/bin/python
+"""
+Builds a deterministic corpus of synthetic feeds to benchmark parsing with.
+
+Every feed is generated from a seed, so the same case always produces the
+same bytes and runs on different builds can be compared. There are feeds in
+each of the formats we see (RSS 0.91 and 2.0, RSS 1.0 RDF, Atom 0.3 and
+1.0) from 5 to 5000 entries, with html heavy content, in encodings other
+than utf-8, and deliberately malformed ones that the strict parser gives up
+on so the loose parser has to do the work.
+
+usage: python benchmarks/corpus.py <directory> [--quick]
+
+writes each feed of the corpus to a file in directory
+"""
+
+import os
+import sys
+import random
+import zlib
+
+FORMATS = ("rss091", "rss20", "rss10", "atom03", "atom10")
+
+# html pieces entries are built from, like the ones blogs and news sites
+# send: links and images with relative urls, inline styles, tables,
+# scripts and iframes to sanitize away and some microformats
+HTML_PIECES = [
+    u'<p class="intro">Some text for story %(n)d with <a href="/story/%(n)d" '
+    u'title="Story" rel="bookmark">a link</a> and <em>emphasis</em>.</p>',
+    u'<img src="/img/%(n)d.jpg" alt="photo" width="300" height="200" '
+    u'onclick="steal()" />',
+    u'<div style="color: red; background: white url(x.png); margin: 0 auto">'
+    u'styled</div>',
+    u'<table border="1"><tr><th>a</th><td align="left">%(n)d</td></tr>'
+    u'</table>',
+    u'<script type="text/javascript">document.write("%(n)d")</script>',
+    u'<iframe src="http://ads.example.com/%(n)d"></iframe>',
+    u'<ul><li>one</li><li>two &amp; three</li></ul><br/>',
+    u'<blockquote cite="http://example.com/q">quoted <b>text</b>'
+    u'</blockquote>',
+    u'<a href="http://example.com/tags/news" rel="tag">news</a> '
+    u'<a href="/files/%(n)d.mp3" rel="enclosure">audio</a>',
+    u'<p>Caf\xe9 cr\xe8me, na\xefve r\xe9sum\xe9, \xfcber \xa3%(n)d</p>',
+    u'<!-- a comment -->',
+]
+
+WORDS = [u"feed", u"story", u"news", u"today", u"market", u"update",
+         u"report", u"city", u"caf\xe9", u"na\xefve", u"weather", u"vote"]
+
+
+class Case(object):
+    """
+    One feed of the corpus. data() builds the feed's bytes from the seed
+    each time it's called, so a corpus of big feeds doesn't have to be
+    held in memory
+    """
+
+    def __init__(self, format, entries, encoding="utf-8", html=True,
+                 malformed=False, seed=1):
+        self.format = format
+        self.entries = entries
+        self.encoding = encoding
+        self.html = html
+        self.malformed = malformed
+        self.seed = seed
+
+    @property
+    def name(self):
+        name = "%s-%d" % (self.format, self.entries)
+        if self.encoding != "utf-8":
+            name += "-" + self.encoding
+        if not self.html:
+            name += "-text"
+        if self.malformed:
+            name += "-malformed"
+        return name
+
+    def data(self):
+        return make_feed(self.format, self.entries, self.encoding, self.html,
+                         self.malformed, self.seed)
+
+
+def make_corpus(quick=False, seed=1):
+    """
+    Returns the list of cases in the corpus. quick leaves out the feeds of
+    5000 entries
+    """
+    sizes = (5, 50, 500)
+    if not quick:
+        sizes = sizes + (5000,)
+
+    cases = []
+    for format in FORMATS:
+        for size in sizes:
+            cases.append(Case(format, size, seed=seed))
+    for format in ("rss20", "atom10"):
+        cases.append(Case(format, 50, html=False, seed=seed))
+    for encoding in ("iso-8859-1", "windows-1252"):
+        cases.append(Case("rss20", 50, encoding=encoding, seed=seed))
+    cases.append(Case("atom10", 50, encoding="iso-8859-1", seed=seed))
+    for format in ("rss20", "atom10"):
+        for size in (50, 500):
+            cases.append(Case(format, size, malformed=True, seed=seed))
+    return cases
+
+
+def _escape(text):
+    return text.replace(u"&", u"&amp;").replace(u"<", u"&lt;") \
+               .replace(u">", u"&gt;")
+
+
+def _text(rng, count):
+    return u" ".join([rng.choice(WORDS) for i in range(count)])
+
+
+def _content(rng, n, html):
+    if not html:
+        return _text(rng, rng.choice([10, 40, 120]))
+    length = rng.choice([3, 10, 40])
+    return u"".join([rng.choice(HTML_PIECES) % {"n": n}
+                     for i in range(length)])
+
+
+def _date(rng, n, format):
+    # a day apart going back from 2011-06-30
+    day = 30 - n % 30
+    hour = rng.randint(0, 23)
+    if format in ("atom03", "atom10", "rss10"):
+        return u"2011-06-%02dT%02d:%02d:00Z" % (day, hour, n % 60)
+    return u"%s, %02d Jun 2011 %02d:%02d:00 GMT" % (
+        ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")[day % 7], day,
+        hour, n % 60)
+
+
+def _item(rng, format, n, html, malformed):
+    title = _escape(_text(rng, rng.randint(3, 10)))
+    link = u"http://example.com/%d/story-%d?utm_source=feed&amp;id=%d" % (
+        2011, n, n)
+    date = _date(rng, n, format)
+    content = _content(rng, n, html)
+    if malformed and n % 3 == 0:
+        # raw markup and a bare ampersand, which a strict parser rejects
+        body = content + u" & more"
+    else:
+        body = _escape(content)
+
+    if format in ("rss091", "rss20"):
+        parts = [u"<item>", u"<title>%s</title>" % title,
+                 u"<link>%s</link>" % link,
+                 u"<description>%s</description>" % body]
+        if format == "rss20":
+            parts += [u'<guid isPermaLink="false">story-%d</guid>' % n,
+                      u"<pubDate>%s</pubDate>" % date,
+                      u"<category>%s</category>" % rng.choice(WORDS),
+                      u"<author>writer%d@example.com (Writer %d)</author>" %
+                      (n % 7, n % 7)]
+            if n % 4 == 0:
+                parts.append(u'<enclosure url="http://example.com/%d.mp3" '
+                             u'length="%d" type="audio/mpeg" />' % (n, n * 1000))
+        parts.append(u"</item>")
+    elif format == "rss10":
+        parts = [u'<item rdf:about="http://example.com/story/%d">' % n,
+                 u"<title>%s</title>" % title, u"<link>%s</link>" % link,
+                 u"<description>%s</description>" % body,
+                 u"<dc:date>%s</dc:date>" % date,
+                 u"<dc:creator>Writer %d</dc:creator>" % (n % 7),
+                 u"</item>"]
+    else:
+        updated = format == "atom10" and u"updated" or u"modified"
+        content_type = format == "atom10" and u'type="html"' or \
+            u'type="text/html" mode="escaped"'
+        parts = [u"<entry>", u'<title type="text">%s</title>' % title,
+                 u'<link rel="alternate" type="text/html" href="%s" />' % link,
+                 u"<id>tag:example.com,2011:story-%d</id>" % n,
+                 u"<%s>%s</%s>" % (updated, date, updated),
+                 u"<author><name>Writer %d</name>"
+                 u"<email>writer%d@example.com</email></author>" %
+                 (n % 7, n % 7),
+                 u"<summary>%s</summary>" % _escape(_text(rng, 20)),
+                 u'<content %s xml:base="http://example.com/%d/">%s</content>'
+                 % (content_type, n, body)]
+        if format == "atom10":
+            parts.insert(5, u'<category term="%s" />' % rng.choice(WORDS))
+        else:
+            parts.insert(5, u"<issued>%s</issued>" % date)
+        parts.append(u"</entry>")
+    return u"\n".join(parts)
+
+
+def make_feed(format, entries, encoding="utf-8", html=True, malformed=False,
+              seed=1):
+    """
+    Returns a feed as bytes in the given encoding
+    """
+    # crc32 rather than the string itself, whose hash can be randomized
+    rng = random.Random(zlib.crc32("%s-%s-%d" % (seed, format, entries)))
+    items = u"\n".join([_item(rng, format, n, html, malformed)
+                        for n in range(entries)])
+    title = u"Benchmark feed (%s, %d entries)" % (format, entries)
+    date = _date(rng, 0, format)
+
+    if format in ("rss091", "rss20"):
+        version = format == "rss20" and u"2.0" or u"0.91"
+        feed = (u'<rss version="%s"><channel>\n<title>%s</title>\n'
+                u'<link>http://example.com/</link>\n'
+                u'<description>A feed for benchmarks</description>\n'
+                u'<language>en-us</language>\n<lastBuildDate>%s'
+                u'</lastBuildDate>\n%s\n</channel></rss>'
+                % (version, title, date, items))
+    elif format == "rss10":
+        feed = (u'<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" '
+                u'xmlns="http://purl.org/rss/1.0/" '
+                u'xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
+                u'<channel rdf:about="http://example.com/">\n'
+                u'<title>%s</title>\n<link>http://example.com/</link>\n'
+                u'<description>A feed for benchmarks</description>\n'
+                u'<dc:date>%s</dc:date>\n</channel>\n%s\n</rdf:RDF>'
+                % (title, date, items))
+    elif format == "atom03":
+        feed = (u'<feed version="0.3" xmlns="http://purl.org/atom/ns#">\n'
+                u'<title>%s</title>\n'
+                u'<link rel="alternate" type="text/html" '
+                u'href="http://example.com/" />\n'
+                u'<modified>%s</modified>\n%s\n</feed>' % (title, date, items))
+    else:
+        feed = (u'<feed xmlns="http://www.w3.org/2005/Atom" '
+                u'xml:base="http://example.com/">\n<title>%s</title>\n'
+                u'<id>tag:example.com,2011:feed</id>\n'
+                u'<link rel="alternate" href="http://example.com/" />\n'
+                u'<updated>%s</updated>\n%s\n</feed>' % (title, date, items))
+
+    declaration = u'<?xml version="1.0" encoding="%s"?>\n' % encoding
+    return (declaration + feed).encode(encoding, "xmlcharrefreplace")
+
+
+def main(argv):
+    if len(argv) < 2:
+        print "usage: python benchmarks/corpus.py <directory> [--quick]"
+        return 1
+    directory = argv[1]
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for case in make_corpus(quick="--quick" in argv):
+        data = case.data()
+        open(os.path.join(directory, case.name + ".xml"), "wb").write(data)
+        print "%-32s %9d bytes" % (case.name, len(data))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
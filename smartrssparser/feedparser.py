@@ -86,6 +86,11 @@ RESOLVE_RELATIVE_URIS = 1
 # HTML content, set this to 1.
 SANITIZE_HTML = 1
 
+# If you want every parse to count its fetch, status, bozo exception, parser
+# and entries and time its stages in a metrics registry, set this to a
+# MetricsRegistry.
+METRICS = None
+
 # ---------- Python 3 modules (make it work if possible) ----------
 try:
     import rfc822
@@ -145,7 +150,7 @@ ACCEPTABLE_URI_SCHEMES = (
 #ACCEPTABLE_URI_SCHEMES = ()
 
 # ---------- required modules (should come with any Python distribution) ----------
-import sgmllib, re, sys, copy, urlparse, time, types, cgi, urllib, urllib2, datetime
+import sgmllib, re, sys, os, copy, urlparse, time, types, cgi, urllib, urllib2, datetime, codecs, socket, bisect
 # Retickr patching
 import eventlet
 from eventlet.green import urllib2 as green_urllib2
@@ -232,6 +237,20 @@ try:
 except:
     BeautifulSoup = None
 
+# sqlite3 is used for HTMLCache's optional on-disk store
+try:
+    import sqlite3
+except:
+    sqlite3 = None
+try:
+    from hashlib import sha1 as _sha1
+except ImportError:
+    from sha import new as _sha1
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 # ---------- don't touch these ----------
 class ThingsNobodyCaresAboutButMe(Exception): pass
 class CharacterEncodingOverride(ThingsNobodyCaresAboutButMe): pass
@@ -309,7 +328,13 @@ class FeedParserDict(UserDict):
               'copyright_detail': 'rights_detail',
               'tagline': 'subtitle',
               'tagline_detail': 'subtitle_detail'}
+    # keys whose values are computed from other keys rather than stored
+    computed_keys = {'category': 1, 'enclosures': 1, 'license': 1, 'categories': 1}
+
     def __getitem__(self, key):
+        if not self._slowkeys.has_key(key):
+            # neither an alias nor computed, which is nearly every lookup
+            return UserDict.__getitem__(self, key)
         if key == 'category':
             return UserDict.__getitem__(self, 'tags')[0]['term']
         if key == 'enclosures':
@@ -331,14 +356,11 @@ class FeedParserDict(UserDict):
         return UserDict.__getitem__(self, realkey)
 
     def __setitem__(self, key, value):
-        for k in self.keymap.keys():
-            if key == k:
-                key = self.keymap[k]
-                if type(key) == types.ListType:
-                    key = key[0]
-        return UserDict.__setitem__(self, key, value)
+        return UserDict.__setitem__(self, self._setkeymap.get(key, key), value)
 
     def get(self, key, default=None):
+        if not self._slowkeys.has_key(key):
+            return UserDict.get(self, key, default)
         if self.has_key(key):
             return self[key]
         else:
@@ -350,10 +372,16 @@ class FeedParserDict(UserDict):
         return self[key]
         
     def has_key(self, key):
-        try:
-            return hasattr(self, key) or UserDict.__contains__(self, key)
-        except AttributeError:
-            return False
+        if UserDict.__contains__(self, key):
+            return True
+        if self._slowkeys.has_key(key):
+            try:
+                self[key]
+            except:
+                return False
+            return True
+        # attributes count as keys, as they always have
+        return hasattr(self.__class__, key) or self.__dict__.has_key(key)
     # This alias prevents the 2to3 tool from changing the semantics of the
     # __contains__ function below and exhausting the maximum recursion depth
     __has_key = has_key
@@ -378,6 +406,25 @@ class FeedParserDict(UserDict):
     def __contains__(self, key):
         return self.__has_key(key)
 
+def _keymapTables(keymap, computed_keys):
+    '''Precompute FeedParserDict's alias lookups from its keymap
+
+    Returns the table __setitem__ uses to map an alias to the key it's stored
+    under and the table of keys __getitem__ can't just look up directly.
+    Call again (and reassign) after changing FeedParserDict.keymap.
+    '''
+    setkeymap = {}
+    slowkeys = computed_keys.copy()
+    for alias, realkey in keymap.items():
+        if type(realkey) == types.ListType:
+            realkey = realkey[0]
+        setkeymap[alias] = realkey
+        slowkeys[alias] = 1
+    return setkeymap, slowkeys
+
+FeedParserDict._setkeymap, FeedParserDict._slowkeys = \
+    _keymapTables(FeedParserDict.keymap, FeedParserDict.computed_keys)
+
 def zopeCompatibilityHack():
     global FeedParserDict
     del FeedParserDict
@@ -442,6 +489,119 @@ _cp1252 = {
   unichr(158): unichr( 382), # latin small letter z with caron
   unichr(159): unichr( 376)} # latin capital letter y with diaeresis
 
+# _cp1252 as a unicode.translate() table, and a quick check for whether a
+# string has anything in it to translate
+_cp1252_table = dict([(ord(k), v) for k, v in _cp1252.items()])
+_c1_controls = re.compile(u'[\x80-\x9f]')
+
+class LazyContent:
+    '''An htmlish value whose post-processing is deferred until it is read
+
+    When parse() is called with lazy_content=1, the values of htmlish
+    content, summary, title, etc. elements are stored as LazyContent objects
+    holding the raw markup along with its content type and base URI.  The
+    relative URI resolution and sanitizing that parse() would normally do up
+    front happen the first time value() is called, and the result is
+    memoized.
+
+    Markup that may hold microformats (tags, enclosures, XFN, vCards) is
+    still processed while parsing when microformats are parsed, so the
+    entry's tags and links are the same as in a parse that isn't lazy.  A
+    LazyContent only keeps the parser's settings, not the parser itself.
+    '''
+    def __init__(self, processor, element, raw, contenttype, baseuri):
+        self.raw = raw
+        self.type = contenttype
+        self.base = baseuri
+        self._element = element
+        self._processor = processor
+        self._value = None
+
+    def value(self):
+        if self._processor is not None:
+            self._value = self._processor._postProcess(self._element, self.raw, 1, self.type, self.base, None)
+            # the settings and raw markup aren't needed any more
+            self._processor = self.raw = None
+        return self._value
+
+    def __len__(self):
+        if self._processor is not None:
+            return len(self.raw)
+        return len(self._value)
+
+    def __unicode__(self):
+        return self.value()
+
+    def __repr__(self):
+        return '<LazyContent %s>' % repr(self.raw is None and self._value or self.raw)
+
+    # the value is effectively immutable and its parser can't be copied
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+class ContentDetail(dict):
+    '''The type, language, base and value of a content or *_detail element
+
+    pop() used to deepcopy the parser's contentparams FeedParserDict for
+    every content element and every title_detail, summary_detail, etc.  A
+    ContentDetail is a dict built from contentparams directly that can't be
+    changed afterwards, so it's cheap to create and never needs copying.
+    It reads like a FeedParserDict (detail['value'], detail.get('src'),
+    detail.value) and is still a dict, so json.dumps and isinstance(detail,
+    dict) work and detail.copy() or dict(detail) give a plain dict that can
+    be changed.  Fields the element didn't have (usually src) are missing
+    keys.
+
+    >>> detail = ContentDetail({'type': 'text/plain', 'language': None}, u'hi')
+    >>> import json; json.loads(json.dumps(detail)) == detail.copy()
+    True
+    >>> detail['value'] = u'bye'
+    Traceback (most recent call last):
+    ...
+    TypeError: ContentDetail is immutable
+    '''
+    __slots__ = ()
+
+    _paramKeys = ('type', 'language', 'base', 'src')
+
+    def __init__(self, contentparams, value):
+        dict.__init__(self, [(key, contentparams[key]) for key in self._paramKeys if contentparams.has_key(key)])
+        dict.__setitem__(self, 'value', value)
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError, key
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError, 'ContentDetail is immutable'
+
+    __setitem__ = __delitem__ = __setattr__ = __delattr__ = _immutable
+    update = setdefault = pop = popitem = clear = _immutable
+
+    def __reduce__(self):
+        return (_makeContentDetail, (self.items(),))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+def _makeContentDetail(items):
+    value = None
+    contentparams = {}
+    for key, fieldvalue in items:
+        if key == 'value':
+            value = fieldvalue
+        else:
+            contentparams[key] = fieldvalue
+    return ContentDetail(contentparams, value)
+
 _urifixer = re.compile('^([A-Za-z][A-Za-z0-9+-.]*://)(/*)(.*?)')
 def _urljoin(base, uri):
     uri = _urifixer.sub(r'\1\3', uri)
@@ -522,6 +682,7 @@ class _FeedParserMixin:
     can_contain_relative_uris = ['content', 'title', 'summary', 'info', 'tagline', 'subtitle', 'copyright', 'rights', 'description']
     can_contain_dangerous_markup = ['content', 'title', 'summary', 'info', 'tagline', 'subtitle', 'copyright', 'rights', 'description']
     html_types = ['text/html', 'application/xhtml+xml']
+    timings = None # a _Timings while the parse is being timed
     
     def __init__(self, baseuri=None, baselang=None, encoding='utf-8'):
         if _debug: sys.stderr.write('initializing FeedParser\n')
@@ -556,9 +717,29 @@ class _FeedParserMixin:
         self.lang = baselang or None
         self.svgOK = 0
         self.hasTitle = 0
+        self.knownEntry = 0 # the current entry's id or link is in config.known_ids
+        self._setConfig(ParserConfig())
         if baselang:
             self.feeddata['language'] = baselang.replace('_','-')
 
+    def _setConfig(self, config):
+        self.config = config
+        self.fields = config.fields # entry keys to keep, see _projectFields
+        self.lazy_content = config.lazy_content # defer html post-processing, see LazyContent
+        self._markupProcessor = None
+        # which date handler parsed which shape of date string, see _parse_date
+        self.dateFormats = config.date_formats
+        if self.dateFormats is None:
+            self.dateFormats = {}
+        known_ids = config.known_ids
+        if known_ids is None or callable(known_ids):
+            self.isKnown = known_ids
+        else:
+            self.isKnown = lambda value: value in known_ids
+
+    def _parseDate(self, dateString):
+        return _parse_date(dateString, self.config.date_handlers, self.dateFormats)
+
     def unknown_starttag(self, tag, attrs):
         if _debug: sys.stderr.write('start %s with %s\n' % (tag, attrs))
         # normalize attrs
@@ -835,6 +1016,12 @@ class _FeedParserMixin:
             output = output.strip()
         if not expectingText: return output
 
+        # entry elements outside the requested projection are dropped here,
+        # before any of the expensive post-processing below, unless their
+        # value also ends up under a key that was asked for
+        if self._skipElement(element):
+            return output
+
         # decode base64 content
         if base64 and self.contentparams.get('base64', 0):
             try:
@@ -869,50 +1056,16 @@ class _FeedParserMixin:
         except KeyError:
             pass
 
-        is_htmlish = self.mapContentType(self.contentparams.get('type', 'text/html')) in self.html_types
-        # resolve relative URIs within embedded markup
-        if is_htmlish and RESOLVE_RELATIVE_URIS:
-            if element in self.can_contain_relative_uris:
-                output = _resolveRelativeURIs(output, self.baseuri, self.encoding, self.contentparams.get('type', 'text/html'))
-                
-        # parse microformats
-        # (must do this before sanitizing because some microformats
-        # rely on elements that we sanitize)
-        if is_htmlish and element in ['content', 'description', 'summary']:
-            mfresults = _parseMicroformats(output, self.baseuri, self.encoding)
-            if mfresults:
-                for tag in mfresults.get('tags', []):
-                    self._addTag(tag['term'], tag['scheme'], tag['label'])
-                for enclosure in mfresults.get('enclosures', []):
-                    self._start_enclosure(enclosure)
-                for xfn in mfresults.get('xfn', []):
-                    self._addXFN(xfn['relationships'], xfn['href'], xfn['name'])
-                vcard = mfresults.get('vcard')
-                if vcard:
-                    self._getContext()['vcard'] = vcard
-        
-        # sanitize embedded markup
-        if is_htmlish and SANITIZE_HTML:
-            if element in self.can_contain_dangerous_markup:
-                output = _sanitizeHTML(output, self.encoding, self.contentparams.get('type', 'text/html'))
-
-        if self.encoding and type(output) != type(u''):
-            try:
-                output = unicode(output, self.encoding)
-            except:
-                pass
-
-        # address common error where people take data that is already
-        # utf-8, presume that it is iso-8859-1, and re-encode it.
-        if self.encoding in ('utf-8', 'utf-8_INVALID_PYTHON_3') and type(output) == type(u''):
-            try:
-                output = unicode(output.encode('iso-8859-1'), 'utf-8')
-            except:
-                pass
-
-        # map win-1252 extensions to the proper code points
-        if type(output) == type(u''):
-            output = u''.join([c in _cp1252.keys() and _cp1252[c] or c for c in output])
+        contenttype = self.contentparams.get('type', 'text/html')
+        is_htmlish = self.mapContentType(contenttype) in self.html_types
+        if is_htmlish and self.lazy_content and element in self.can_contain_dangerous_markup and \
+           not (self.config.parse_microformats and BeautifulSoup and element in ['content', 'description', 'summary'] and _mayHaveMicroformats(output)):
+            # leave the expensive part for whoever actually reads the value
+            if self._markupProcessor is None:
+                self._markupProcessor = _MarkupProcessor(self)
+            output = LazyContent(self._markupProcessor, element, output, contenttype, self.baseuri)
+        else:
+            output = self._postProcess(element, output, is_htmlish, contenttype, self.baseuri, self._getContext())
 
         # categories/tags/keywords/whatever are handled in _end_category
         if element == 'category':
@@ -924,27 +1077,28 @@ class _FeedParserMixin:
         # store output in appropriate place(s)
         if self.inentry and not self.insource:
             if element == 'content':
-                self.entries[-1].setdefault(element, [])
-                contentparams = copy.deepcopy(self.contentparams)
-                contentparams['value'] = output
-                self.entries[-1][element].append(contentparams)
+                if not self._skipEntryKey('content'):
+                    self.entries[-1].setdefault(element, [])
+                    self.entries[-1][element].append(ContentDetail(self.contentparams, output))
             elif element == 'link':
                 if not self.inimage:
                     # query variables in urls in link elements are improperly
                     # converted from `?a=1&b=2` to `?a=1&b;=2` as if they're
                     # unhandled character references. fix this special case.
                     output = re.sub("&([A-Za-z0-9_]+);", "&\g<1>", output)
-                    self.entries[-1][element] = output
-                    if output:
+                    if self._keepKey('link'):
+                        self.entries[-1][element] = output
+                    if output and not self._skipEntryKey('links'):
                         self.entries[-1]['links'][-1]['href'] = output
             else:
                 if element == 'description':
                     element = 'summary'
-                self.entries[-1][element] = output
-                if self.incontent:
-                    contentparams = copy.deepcopy(self.contentparams)
-                    contentparams['value'] = output
-                    self.entries[-1][element + '_detail'] = contentparams
+                if self._keepKey(element):
+                    self.entries[-1][element] = output
+                    if self.incontent:
+                        self.entries[-1][element + '_detail'] = ContentDetail(self.contentparams, output)
+            if element in ('id', 'link'):
+                self._checkKnown(output)
         elif (self.infeed or self.insource):# and (not self.intextinput) and (not self.inimage):
             context = self._getContext()
             if element == 'description':
@@ -956,11 +1110,86 @@ class _FeedParserMixin:
                 context[element] = output
                 context['links'][-1]['href'] = output
             elif self.incontent:
-                contentparams = copy.deepcopy(self.contentparams)
-                contentparams['value'] = output
-                context[element + '_detail'] = contentparams
+                context[element + '_detail'] = ContentDetail(self.contentparams, output)
+        return output
+
+    def _postProcess(self, element, output, is_htmlish, contenttype, baseuri, context):
+        cache = self.config.html_cache
+        if cache is not None and is_htmlish:
+            output, mfresults = cache.process(self, element, output, contenttype, baseuri)
+        else:
+            output, mfresults = self._processMarkup(element, output, is_htmlish, contenttype, baseuri)
+
+        if mfresults:
+            for tag in mfresults.get('tags', []):
+                self._addTag(tag['term'], tag['scheme'], tag['label'], context)
+            for enclosure in mfresults.get('enclosures', []):
+                self._start_enclosure(enclosure, context)
+            for xfn in mfresults.get('xfn', []):
+                self._addXFN(xfn['relationships'], xfn['href'], xfn['name'], context)
+            vcard = mfresults.get('vcard')
+            if vcard and not self._skipEntryKey('vcard'):
+                context['vcard'] = vcard
+
+        if self.encoding and type(output) != type(u''):
+            try:
+                output = unicode(output, self.encoding)
+            except:
+                pass
+
+        # address common error where people take data that is already
+        # utf-8, presume that it is iso-8859-1, and re-encode it.
+        if self.encoding in ('utf-8', 'utf-8_INVALID_PYTHON_3') and type(output) == type(u''):
+            try:
+                output = unicode(output.encode('iso-8859-1'), 'utf-8')
+            except:
+                pass
+
+        # map win-1252 extensions to the proper code points
+        if type(output) == type(u'') and _c1_controls.search(output):
+            output = output.translate(_cp1252_table)
         return output
 
+    def _processMarkup(self, element, output, is_htmlish, contenttype, baseuri):
+        '''Resolve relative URIs in, parse microformats from and sanitize markup
+
+        Returns the processed markup and the microformats found (or None);
+        which of these get done depends on the element and on self.config.
+        '''
+        config = self.config
+        timings = self.timings
+        mfresults = None
+        parse_microformats = config.parse_microformats and is_htmlish and element in ['content', 'description', 'summary']
+        if is_htmlish and config.resolve_relative_uris and config.sanitize_html and \
+           element in self.can_contain_relative_uris and element in self.can_contain_dangerous_markup:
+            # resolve, parse microformats and sanitize in a single pass
+            if timings is not None: timings.start('sanitize')
+            output, mfresults = _processHTML(output, baseuri, self.encoding, contenttype, parse_microformats, config)
+            if timings is not None: timings.stop('sanitize', len(output))
+        else:
+            # resolve relative URIs within embedded markup
+            if is_htmlish and config.resolve_relative_uris:
+                if element in self.can_contain_relative_uris:
+                    if timings is not None: timings.start('sanitize')
+                    output = _resolveRelativeURIs(output, baseuri, self.encoding, contenttype)
+                    if timings is not None: timings.stop('sanitize')
+
+            # parse microformats
+            # (must do this before sanitizing because some microformats
+            # rely on elements that we sanitize)
+            if parse_microformats:
+                if timings is not None: timings.start('microformats')
+                mfresults = _parseMicroformats(output, baseuri, self.encoding)
+                if timings is not None: timings.stop('microformats', len(output))
+
+            # sanitize embedded markup
+            if is_htmlish and config.sanitize_html:
+                if element in self.can_contain_dangerous_markup:
+                    if timings is not None: timings.start('sanitize')
+                    output = _sanitizeHTML(output, self.encoding, contenttype, config)
+                    if timings is not None: timings.stop('sanitize', len(output))
+        return output, mfresults
+
     def pushContent(self, tag, attrsD, defaultContentType, expectingText):
         self.incontent += 1
         if self.lang: self.lang=self.lang.replace('_','-')
@@ -1036,7 +1265,53 @@ class _FeedParserMixin:
             attrsD['href'] = href
         return attrsD
     
+    def _skipEntryKey(self, key):
+        return (self.knownEntry or (self.fields is not None and key not in self.fields)) and self.inentry and not self.insource
+
+    # the entry keys an element's value can be stored under: content is
+    # copied to summary, an RSS <link> is also the href of its links entry,
+    # a permalink guid is also the link, categories are tags, a license is
+    # a links entry and names, emails and urls belong to a person
+    _elementKeys = {'description': ('summary',),
+                    'content': ('content', 'summary'),
+                    'link': ('link', 'links'),
+                    'id': ('id', 'link'),
+                    'category': ('tags',),
+                    'itunes_keywords': ('tags',),
+                    'license': ('links',),
+                    'name': ('author', 'publisher', 'contributors'),
+                    'email': ('author', 'publisher', 'contributors'),
+                    'href': ('author', 'contributors')}
+
+    # and the microformats found in these are added to the entry's tags,
+    # links (enclosures), xfn and vcard
+    _microformatKeys = ('tags', 'links', 'xfn', 'vcard')
+
+    def _skipElement(self, element):
+        keys = self._elementKeys.get(element, (element,))
+        if self.config.parse_microformats and element in ('content', 'description', 'summary'):
+            keys = keys + self._microformatKeys
+        for key in keys:
+            if self._keepKey(key):
+                return 0
+        return 1
+
+    def _keepKey(self, key):
+        # ids and links are read whatever the projection while there are
+        # known_ids to check them against; _end_item drops the ones that
+        # weren't asked for
+        if key in ('id', 'link') and self.isKnown is not None and not self.knownEntry:
+            return 1
+        return not self._skipEntryKey(key)
+
+    def _checkKnown(self, value):
+        # once an entry turns out to be known, _skipEntryKey drops the rest
+        # of it and _end_item cuts it down to a stub
+        if self.isKnown is not None and value and self.isKnown(value):
+            self.knownEntry = 1
+
     def _save(self, key, value, overwrite=False):
+        if self._skipEntryKey(key): return
         context = self._getContext()
         if overwrite:
             context[key] = value
@@ -1125,6 +1400,7 @@ class _FeedParserMixin:
         self.inauthor = 1
         self.push('author', 1)
         # Append a new FeedParserDict when expecting an author
+        if self._skipEntryKey('author'): return
         context = self._getContext()
         context.setdefault('authors', [])
         context['authors'].append(FeedParserDict())
@@ -1153,9 +1429,10 @@ class _FeedParserMixin:
 
     def _start_contributor(self, attrsD):
         self.incontributor = 1
-        context = self._getContext()
-        context.setdefault('contributors', [])
-        context['contributors'].append(FeedParserDict())
+        if not self._skipEntryKey('contributors'):
+            context = self._getContext()
+            context.setdefault('contributors', [])
+            context['contributors'].append(FeedParserDict())
         self.push('contributor', 0)
 
     def _end_contributor(self):
@@ -1164,9 +1441,10 @@ class _FeedParserMixin:
 
     def _start_dc_contributor(self, attrsD):
         self.incontributor = 1
-        context = self._getContext()
-        context.setdefault('contributors', [])
-        context['contributors'].append(FeedParserDict())
+        if not self._skipEntryKey('contributors'):
+            context = self._getContext()
+            context.setdefault('contributors', [])
+            context['contributors'].append(FeedParserDict())
         self.push('name', 0)
 
     def _end_dc_contributor(self):
@@ -1258,6 +1536,7 @@ class _FeedParserMixin:
         return context
 
     def _save_author(self, key, value, prefix='author'):
+        if self._skipEntryKey(prefix): return
         context = self._getContext()
         context.setdefault(prefix + '_detail', FeedParserDict())
         context[prefix + '_detail'][key] = value
@@ -1266,11 +1545,13 @@ class _FeedParserMixin:
         context['authors'][-1][key] = value
 
     def _save_contributor(self, key, value):
+        if self._skipEntryKey('contributors'): return
         context = self._getContext()
         context.setdefault('contributors', [FeedParserDict()])
         context['contributors'][-1][key] = value
 
     def _sync_author_detail(self, key='author'):
+        if self._skipEntryKey(key): return
         context = self._getContext()
         detail = context.get('%s_detail' % key)
         if detail:
@@ -1332,10 +1613,12 @@ class _FeedParserMixin:
         self.inentry = 1
         self.guidislink = 0
         self.hasTitle = 0
+        self.knownEntry = 0
         id = self._getAttribute(attrsD, 'rdf:about')
         if id:
             context = self._getContext()
             context['id'] = id
+            self._checkKnown(id)
         self._cdf_common(attrsD)
     _start_entry = _start_item
     _start_product = _start_item
@@ -1343,6 +1626,20 @@ class _FeedParserMixin:
     def _end_item(self):
         self.pop('item')
         self.inentry = 0
+        if self.knownEntry:
+            self.knownEntry = 0
+            entry = self.entries[-1]
+            stub = FeedParserDict()
+            for key in ('id', 'link'):
+                if entry.has_key(key):
+                    stub[key] = entry[key]
+            stub['known'] = 1
+            self.entries[-1] = stub
+        elif self.isKnown is not None and self.fields is not None:
+            entry = self.entries[-1]
+            for key in ('id', 'link'):
+                if key not in self.fields and entry.has_key(key):
+                    del entry[key]
     _end_entry = _end_item
 
     def _start_dc_language(self, attrsD):
@@ -1369,7 +1666,8 @@ class _FeedParserMixin:
 
     def _end_published(self):
         value = self.pop('published')
-        self._save('published_parsed', _parse_date(value), overwrite=True)
+        if self._skipEntryKey('published_parsed'): return
+        self._save('published_parsed', self._parseDate(value), overwrite=True)
     _end_dcterms_issued = _end_published
     _end_issued = _end_published
 
@@ -1383,7 +1681,8 @@ class _FeedParserMixin:
 
     def _end_updated(self):
         value = self.pop('updated')
-        parsed_value = _parse_date(value)
+        if self._skipEntryKey('updated_parsed'): return
+        parsed_value = self._parseDate(value)
         self._save('updated_parsed', parsed_value, overwrite=True)
     _end_modified = _end_updated
     _end_dcterms_modified = _end_updated
@@ -1397,14 +1696,17 @@ class _FeedParserMixin:
 
     def _end_created(self):
         value = self.pop('created')
-        self._save('created_parsed', _parse_date(value), overwrite=True)
+        if self._skipEntryKey('created_parsed'): return
+        self._save('created_parsed', self._parseDate(value), overwrite=True)
     _end_dcterms_created = _end_created
 
     def _start_expirationdate(self, attrsD):
         self.push('expired', 1)
 
     def _end_expirationdate(self):
-        self._save('expired_parsed', _parse_date(self.pop('expired')), overwrite=True)
+        value = self.pop('expired')
+        if self._skipEntryKey('expired_parsed'): return
+        self._save('expired_parsed', self._parseDate(value), overwrite=True)
 
     def _start_cc_license(self, attrsD):
         context = self._getContext()
@@ -1428,15 +1730,19 @@ class _FeedParserMixin:
         del context['license']
     _end_creativeCommons_license = _end_creativecommons_license
 
-    def _addXFN(self, relationships, href, name):
-        context = self._getContext()
+    def _addXFN(self, relationships, href, name, context=None):
+        if self._skipEntryKey('xfn'): return
+        if context is None:
+            context = self._getContext()
         xfn = context.setdefault('xfn', [])
         value = FeedParserDict({'relationships': relationships, 'href': href, 'name': name})
         if value not in xfn:
             xfn.append(value)
         
-    def _addTag(self, term, scheme, label):
-        context = self._getContext()
+    def _addTag(self, term, scheme, label, context=None):
+        if self._skipEntryKey('tags'): return
+        if context is None:
+            context = self._getContext()
         tags = context.setdefault('tags', [])
         if (not term) and (not scheme) and (not label): return
         value = FeedParserDict({'term': term, 'scheme': scheme, 'label': label})
@@ -1467,7 +1773,7 @@ class _FeedParserMixin:
         
     def _end_category(self):
         value = self.pop('category')
-        if not value: return
+        if not value or self._skipEntryKey('tags'): return
         context = self._getContext()
         tags = context['tags']
         if value and len(tags) and not tags[-1]['term']:
@@ -1493,13 +1799,16 @@ class _FeedParserMixin:
         if attrsD.has_key('href'):
             attrsD['href'] = self.resolveURI(attrsD['href'])
         expectingText = self.infeed or self.inentry or self.insource
-        context.setdefault('links', [])
-        if not (self.inentry and self.inimage):
-            context['links'].append(FeedParserDict(attrsD))
+        if not self._skipEntryKey('links'):
+            context.setdefault('links', [])
+            if not (self.inentry and self.inimage):
+                context['links'].append(FeedParserDict(attrsD))
         if attrsD.has_key('href'):
             expectingText = 0
-            if (attrsD.get('rel') == 'alternate') and (self.mapContentType(attrsD.get('type')) in self.html_types):
+            if (attrsD.get('rel') == 'alternate') and (self.mapContentType(attrsD.get('type')) in self.html_types) and self._keepKey('link'):
                 context['link'] = attrsD['href']
+                if self.inentry and not self.insource:
+                    self._checkKnown(context['link'])
         else:
             self.push('link', expectingText)
     _start_producturl = _start_link
@@ -1616,9 +1925,11 @@ class _FeedParserMixin:
         self._summaryKey = None
     _end_itunes_summary = _end_summary
         
-    def _start_enclosure(self, attrsD):
+    def _start_enclosure(self, attrsD, context=None):
+        if self._skipEntryKey('links'): return
         attrsD = self._itsAnHrefDamnIt(attrsD)
-        context = self._getContext()
+        if context is None:
+            context = self._getContext()
         attrsD['rel']='enclosure'
         context.setdefault('links', []).append(FeedParserDict(attrsD))
             
@@ -1723,6 +2034,27 @@ class _FeedParserMixin:
             return
         context['newlocation'] = _makeSafeAbsoluteURI(self.baseuri, url.strip())
 
+# markup that can't hold microformats, which all need an href or a vcard
+# class, can have its post-processing left to LazyContent
+_mayHaveMicroformats = re.compile('href|vcard', re.I).search
+
+class _MarkupProcessor:
+    '''The parts of a parser LazyContent needs to process its markup
+
+    LazyContent values hold one of these rather than the parser, which
+    would keep everything the parser has read alive until they're read.
+    '''
+    can_contain_relative_uris = _FeedParserMixin.can_contain_relative_uris
+    can_contain_dangerous_markup = _FeedParserMixin.can_contain_dangerous_markup
+    timings = None
+
+    def __init__(self, parser):
+        self.config = parser.config
+        self.encoding = parser.encoding
+
+    _postProcess = _FeedParserMixin._postProcess.im_func
+    _processMarkup = _FeedParserMixin._processMarkup.im_func
+
 if _XML_AVAILABLE:
     class _StrictFeedParser(_FeedParserMixin, xml.sax.handler.ContentHandler):
         def __init__(self, baseuri, baselang, encoding):
@@ -1732,14 +2064,22 @@ if _XML_AVAILABLE:
             self.bozo = 0
             self.exc = None
             self.decls = {}
+            # per-parse memos of normalized tag and attribute names
+            self._startnames = {}
+            self._endnames = {}
+            self._attrnames = {}
         
         def startPrefixMapping(self, prefix, uri):
             self.trackNamespace(prefix, uri)
             if uri == 'http://www.w3.org/1999/xlink':
               self.decls['xmlns:'+prefix] = uri
-        
-        def startElementNS(self, name, qname, attrs):
-            namespace, localname = name
+            # a new prefix mapping can change how any tag or attribute
+            # name resolves, so forget everything we've memoized
+            self._startnames.clear()
+            self._endnames.clear()
+            self._attrnames.clear()
+
+        def _resolveStartName(self, namespace, localname, qname):
             lowernamespace = str(namespace or '').lower()
             if lowernamespace.find('backend.userland.com/rss') <> -1:
                 # match any backend.userland.com namespace
@@ -1761,11 +2101,12 @@ if _XML_AVAILABLE:
             # the qnames the SAX parser gives us (if indeed it gives us any
             # at all).  Thanks to MatejC for helping me test this and
             # tirelessly telling me that it didn't work yet.
-            attrsD, self.decls = self.decls, {}
             if localname=='math' and namespace=='http://www.w3.org/1998/Math/MathML':
-                attrsD['xmlns']=namespace
-            if localname=='svg' and namespace=='http://www.w3.org/2000/svg':
-                attrsD['xmlns']=namespace
+                xmlns = namespace
+            elif localname=='svg' and namespace=='http://www.w3.org/2000/svg':
+                xmlns = namespace
+            else:
+                xmlns = None
 
             if prefix:
                 localname = prefix.lower() + ':' + localname
@@ -1774,23 +2115,48 @@ if _XML_AVAILABLE:
                      if name and value == namespace:
                          localname = name + ':' + localname
                          break
-            if _debug: sys.stderr.write('startElementNS: qname = %s, namespace = %s, givenprefix = %s, prefix = %s, attrs = %s, localname = %s\n' % (qname, namespace, givenprefix, prefix, attrs.items(), localname))
-
-            for (namespace, attrlocalname), attrvalue in attrs._attrs.items():
-                lowernamespace = (namespace or '').lower()
-                prefix = self._matchnamespaces.get(lowernamespace, '')
-                if prefix:
-                    attrlocalname = prefix + ':' + attrlocalname
-                attrsD[str(attrlocalname).lower()] = attrvalue
+            if _debug: sys.stderr.write('startElementNS: qname = %s, namespace = %s, givenprefix = %s, prefix = %s, localname = %s\n' % (qname, namespace, givenprefix, prefix, localname))
+            return localname, xmlns
+
+        def _resolveAttrName(self, namespace, attrlocalname):
+            lowernamespace = (namespace or '').lower()
+            prefix = self._matchnamespaces.get(lowernamespace, '')
+            if prefix:
+                attrlocalname = prefix + ':' + attrlocalname
+            return str(attrlocalname).lower()
+
+        def startElementNS(self, name, qname, attrs):
+            # the same handful of element names repeat for every entry, so
+            # the normalized name is memoized for the life of this parse
+            key = (name, qname)
+            try:
+                localname, xmlns = self._startnames[key]
+            except KeyError:
+                localname, xmlns = self._startnames[key] = self._resolveStartName(name[0], name[1], qname)
+
+            attrsD, self.decls = self.decls, {}
+            if xmlns:
+                attrsD['xmlns'] = xmlns
+
+            attrnames = self._attrnames
+            for attrname, attrvalue in attrs._attrs.items():
+                try:
+                    attrkey = attrnames[attrname]
+                except KeyError:
+                    attrkey = attrnames[attrname] = self._resolveAttrName(*attrname)
+                attrsD[attrkey] = attrvalue
             for qname in attrs.getQNames():
-                attrsD[str(qname).lower()] = attrs.getValueByQName(qname)
+                try:
+                    attrkey = attrnames[qname]
+                except KeyError:
+                    attrkey = attrnames[qname] = str(qname).lower()
+                attrsD[attrkey] = attrs.getValueByQName(qname)
             self.unknown_starttag(localname, attrsD.items())
 
         def characters(self, text):
             self.handle_data(text)
 
-        def endElementNS(self, name, qname):
-            namespace, localname = name
+        def _resolveEndName(self, namespace, localname, qname):
             lowernamespace = str(namespace or '').lower()
             if qname and qname.find(':') > 0:
                 givenprefix = qname.split(':')[0]
@@ -1804,7 +2170,14 @@ if _XML_AVAILABLE:
                      if name and value == namespace:
                          localname = name + ':' + localname
                          break
-            localname = str(localname).lower()
+            return str(localname).lower()
+
+        def endElementNS(self, name, qname):
+            key = (name, qname)
+            try:
+                localname = self._endnames[key]
+            except KeyError:
+                localname = self._endnames[key] = self._resolveEndName(name[0], name[1], qname)
             self.unknown_endtag(localname)
 
         def error(self, exc):
@@ -1818,11 +2191,11 @@ if _XML_AVAILABLE:
 class _BaseHTMLProcessor(sgmllib.SGMLParser):
     special = re.compile('''[<>'"]''')
     bare_ampersand = re.compile("&(?!#\d+;|#x[0-9a-fA-F]+;|\w+;)")
-    elements_no_end_tag = [
+    elements_no_end_tag = frozenset([
       'area', 'base', 'basefont', 'br', 'col', 'command', 'embed', 'frame', 
       'hr', 'img', 'input', 'isindex', 'keygen', 'link', 'meta', 'param',
       'source', 'track', 'wbr'
-    ]
+    ])
 
     def __init__(self, encoding, _type):
         self.encoding = encoding
@@ -1873,28 +2246,34 @@ class _BaseHTMLProcessor(sgmllib.SGMLParser):
         attrs.sort()
         return attrs
 
+    def escape_attrs(self, attrs):
+        # escape attribute values and decode them (and their names) to unicode,
+        # exactly as unknown_starttag writes them out
+        uattrs = []
+        for key, value in attrs:
+            value=value.replace('>','&gt;').replace('<','&lt;').replace('"','&quot;')
+            value = self.bare_ampersand.sub("&amp;", value)
+            # thanks to Kevin Marks for this breathtaking hack to deal with (valid) high-bit attribute values in UTF-8 feeds
+            if type(value) != type(u''):
+                try:
+                    value = unicode(value, self.encoding)
+                except:
+                    value = unicode(value, 'iso-8859-1')
+            try:
+                # Currently, in Python 3 the key is already a str, and cannot be decoded again
+                uattrs.append((unicode(key, self.encoding), value))
+            except TypeError:
+                uattrs.append((key, value))
+        return uattrs
+
     def unknown_starttag(self, tag, attrs):
         # called for each start tag
         # attrs is a list of (attr, value) tuples
         # e.g. for <pre class='screen'>, tag='pre', attrs=[('class', 'screen')]
         if _debug: sys.stderr.write('_BaseHTMLProcessor, unknown_starttag, tag=%s\n' % tag)
-        uattrs = []
         strattrs=''
         if attrs:
-            for key, value in attrs:
-                value=value.replace('>','&gt;').replace('<','&lt;').replace('"','&quot;')
-                value = self.bare_ampersand.sub("&amp;", value)
-                # thanks to Kevin Marks for this breathtaking hack to deal with (valid) high-bit attribute values in UTF-8 feeds
-                if type(value) != type(u''):
-                    try:
-                        value = unicode(value, self.encoding)
-                    except:
-                        value = unicode(value, 'iso-8859-1')
-                try:
-                    # Currently, in Python 3 the key is already a str, and cannot be decoded again
-                    uattrs.append((unicode(key, self.encoding), value))
-                except TypeError:
-                    uattrs.append((key, value))
+            uattrs = self.escape_attrs(attrs)
             strattrs = u''.join([u' %s="%s"' % (key, value) for key, value in uattrs])
             if self.encoding:
                 try:
@@ -1920,7 +2299,7 @@ class _BaseHTMLProcessor(sgmllib.SGMLParser):
         else:
             value = unichr(int(ref))
 
-        if value in _cp1252.keys():
+        if _cp1252.has_key(value):
             self.pieces.append('&#%s;' % hex(ord(_cp1252[value]))[1:])
         else:
             self.pieces.append('&#%(ref)s;' % locals())
@@ -2378,33 +2757,14 @@ class _MicroformatsParser:
         return sVCards.strip()
     
     def isProbablyDownloadable(self, elm):
-        attrsD = elm.attrMap
-        if not attrsD.has_key('href'): return 0
-        linktype = attrsD.get('type', '').strip()
-        if linktype.startswith('audio/') or \
-           linktype.startswith('video/') or \
-           (linktype.startswith('application/') and not linktype.endswith('xml')):
-            return 1
-        path = urlparse.urlparse(attrsD['href'])[2]
-        if path.find('.') == -1: return 0
-        fileext = path.split('.').pop().lower()
-        return fileext in self.known_binary_extensions
+        return _isProbablyDownloadable(elm.attrMap)
 
     def findTags(self):
         all = lambda x: 1
         for elm in self.document(all, {'rel': re.compile(r'\btag\b')}):
             href = elm.get('href')
             if not href: continue
-            urlscheme, domain, path, params, query, fragment = \
-                       urlparse.urlparse(_urljoin(self.baseuri, href))
-            segments = path.split('/')
-            tag = segments.pop()
-            if not tag:
-                tag = segments.pop()
-            tagscheme = urlparse.urlunparse((urlscheme, domain, '/'.join(segments), '', '', ''))
-            if not tagscheme.endswith('/'):
-                tagscheme += '/'
-            self.tags.append(FeedParserDict({"term": tag, "scheme": tagscheme, "label": elm.string or ''}))
+            self.tags.append(_makeRelTag(self.baseuri, href, elm.string))
 
     def findEnclosures(self):
         all = lambda x: 1
@@ -2427,6 +2787,30 @@ class _MicroformatsParser:
             if xfn_rels:
                 self.xfn.append({"relationships": xfn_rels, "href": elm.get('href', ''), "name": elm.string})
 
+def _isProbablyDownloadable(attrsD):
+    if not attrsD.has_key('href'): return 0
+    linktype = attrsD.get('type', '').strip()
+    if linktype.startswith('audio/') or \
+       linktype.startswith('video/') or \
+       (linktype.startswith('application/') and not linktype.endswith('xml')):
+        return 1
+    path = urlparse.urlparse(attrsD['href'])[2]
+    if path.find('.') == -1: return 0
+    fileext = path.split('.').pop().lower()
+    return fileext in _MicroformatsParser.known_binary_extensions
+
+def _makeRelTag(baseuri, href, label):
+    urlscheme, domain, path, params, query, fragment = \
+               urlparse.urlparse(_urljoin(baseuri, href))
+    segments = path.split('/')
+    tag = segments.pop()
+    if not tag:
+        tag = segments.pop()
+    tagscheme = urlparse.urlunparse((urlscheme, domain, '/'.join(segments), '', '', ''))
+    if not tagscheme.endswith('/'):
+        tagscheme += '/'
+    return FeedParserDict({"term": tag, "scheme": tagscheme, "label": label or ''})
+
 def _parseMicroformats(htmlSource, baseURI, encoding):
     if not BeautifulSoup: return
     if _debug: sys.stderr.write('entering _parseMicroformats\n')
@@ -2443,7 +2827,7 @@ def _parseMicroformats(htmlSource, baseURI, encoding):
     return {"tags": p.tags, "enclosures": p.enclosures, "xfn": p.xfn, "vcard": p.vcard}
 
 class _RelativeURIResolver(_BaseHTMLProcessor):
-    relative_uris = [('a', 'href'),
+    relative_uris = frozenset([('a', 'href'),
                      ('applet', 'codebase'),
                      ('area', 'href'),
                      ('blockquote', 'cite'),
@@ -2467,7 +2851,7 @@ class _RelativeURIResolver(_BaseHTMLProcessor):
                      ('object', 'data'),
                      ('object', 'usemap'),
                      ('q', 'cite'),
-                     ('script', 'src')]
+                     ('script', 'src')])
 
     def __init__(self, baseuri, encoding, _type):
         _BaseHTMLProcessor.__init__(self, encoding, _type)
@@ -2508,7 +2892,7 @@ def _makeSafeAbsoluteURI(base, rel=None):
     return uri
 
 class _HTMLSanitizer(_BaseHTMLProcessor):
-    acceptable_elements = ['a', 'abbr', 'acronym', 'address', 'area',
+    acceptable_elements = frozenset(['a', 'abbr', 'acronym', 'address', 'area',
         'article', 'aside', 'audio', 'b', 'big', 'blockquote', 'br', 'button',
         'canvas', 'caption', 'center', 'cite', 'code', 'col', 'colgroup',
         'command', 'datagrid', 'datalist', 'dd', 'del', 'details', 'dfn',
@@ -2520,9 +2904,9 @@ class _HTMLSanitizer(_BaseHTMLProcessor):
         'p', 'pre', 'progress', 'q', 's', 'samp', 'section', 'select',
         'small', 'sound', 'source', 'spacer', 'span', 'strike', 'strong',
         'sub', 'sup', 'table', 'tbody', 'td', 'textarea', 'time', 'tfoot',
-        'th', 'thead', 'tr', 'tt', 'u', 'ul', 'var', 'video', 'noscript']
+        'th', 'thead', 'tr', 'tt', 'u', 'ul', 'var', 'video', 'noscript'])
 
-    acceptable_attributes = ['abbr', 'accept', 'accept-charset', 'accesskey',
+    acceptable_attributes = frozenset(['abbr', 'accept', 'accept-charset', 'accesskey',
       'action', 'align', 'alt', 'autocomplete', 'autofocus', 'axis',
       'background', 'balance', 'bgcolor', 'bgproperties', 'border',
       'bordercolor', 'bordercolordark', 'bordercolorlight', 'bottompadding',
@@ -2543,11 +2927,11 @@ class _HTMLSanitizer(_BaseHTMLProcessor):
       'start', 'step', 'summary', 'suppress', 'tabindex', 'target', 'template',
       'title', 'toppadding', 'type', 'unselectable', 'usemap', 'urn', 'valign',
       'value', 'variable', 'volume', 'vspace', 'vrml', 'width', 'wrap',
-      'xml:lang']
+      'xml:lang'])
 
-    unacceptable_elements_with_end_tag = ['script', 'applet', 'style']
+    unacceptable_elements_with_end_tag = frozenset(['script', 'applet', 'style'])
 
-    acceptable_css_properties = ['azimuth', 'background-color',
+    acceptable_css_properties = frozenset(['azimuth', 'background-color',
       'border-bottom-color', 'border-collapse', 'border-color',
       'border-left-color', 'border-right-color', 'border-top-color', 'clear',
       'color', 'cursor', 'direction', 'display', 'elevation', 'float', 'font',
@@ -2557,26 +2941,26 @@ class _HTMLSanitizer(_BaseHTMLProcessor):
       'speak', 'speak-header', 'speak-numeral', 'speak-punctuation',
       'speech-rate', 'stress', 'text-align', 'text-decoration', 'text-indent',
       'unicode-bidi', 'vertical-align', 'voice-family', 'volume',
-      'white-space', 'width']
+      'white-space', 'width'])
 
     # survey of common keywords found in feeds
-    acceptable_css_keywords = ['auto', 'aqua', 'black', 'block', 'blue',
+    acceptable_css_keywords = frozenset(['auto', 'aqua', 'black', 'block', 'blue',
       'bold', 'both', 'bottom', 'brown', 'center', 'collapse', 'dashed',
       'dotted', 'fuchsia', 'gray', 'green', '!important', 'italic', 'left',
       'lime', 'maroon', 'medium', 'none', 'navy', 'normal', 'nowrap', 'olive',
       'pointer', 'purple', 'red', 'right', 'solid', 'silver', 'teal', 'top',
-      'transparent', 'underline', 'white', 'yellow']
+      'transparent', 'underline', 'white', 'yellow'])
 
     valid_css_values = re.compile('^(#[0-9a-f]+|rgb\(\d+%?,\d*%?,?\d*%?\)?|' +
       '\d{0,2}\.?\d{0,2}(cm|em|ex|in|mm|pc|pt|px|%|,|\))?)$')
 
-    mathml_elements = ['annotation', 'annotation-xml', 'maction', 'math',
+    mathml_elements = frozenset(['annotation', 'annotation-xml', 'maction', 'math',
       'merror', 'mfenced', 'mfrac', 'mi', 'mmultiscripts', 'mn', 'mo', 'mover', 'mpadded',
       'mphantom', 'mprescripts', 'mroot', 'mrow', 'mspace', 'msqrt', 'mstyle',
       'msub', 'msubsup', 'msup', 'mtable', 'mtd', 'mtext', 'mtr', 'munder',
-      'munderover', 'none', 'semantics']
+      'munderover', 'none', 'semantics'])
 
-    mathml_attributes = ['actiontype', 'align', 'columnalign', 'columnalign',
+    mathml_attributes = frozenset(['actiontype', 'align', 'columnalign', 'columnalign',
       'columnalign', 'close', 'columnlines', 'columnspacing', 'columnspan', 'depth',
       'display', 'displaystyle', 'encoding', 'equalcolumns', 'equalrows',
       'fence', 'fontstyle', 'fontweight', 'frame', 'height', 'linethickness',
@@ -2584,7 +2968,7 @@ class _HTMLSanitizer(_BaseHTMLProcessor):
       'maxsize', 'minsize', 'open', 'other', 'rowalign', 'rowalign', 'rowalign',
       'rowlines', 'rowspacing', 'rowspan', 'rspace', 'scriptlevel', 'selection',
       'separator', 'separators', 'stretchy', 'width', 'width', 'xlink:href',
-      'xlink:show', 'xlink:type', 'xmlns', 'xmlns:xlink']
+      'xlink:show', 'xlink:type', 'xmlns', 'xmlns:xlink'])
 
     # svgtiny - foreignObject + linearGradient + radialGradient + stop
     svg_elements = ['a', 'animate', 'animateColor', 'animateMotion',
@@ -2623,12 +3007,25 @@ class _HTMLSanitizer(_BaseHTMLProcessor):
        'xml:base', 'xml:lang', 'xml:space', 'xmlns', 'xmlns:xlink', 'y', 'y1',
        'y2', 'zoomAndPan']
 
-    svg_attr_map = None
-    svg_elem_map = None
+    # for most vocabularies, lowercasing is a good idea.  Many svg elements
+    # and attributes, however, are camel case, so map them back
+    svg_elem_map = dict([(a.lower(), a) for a in svg_elements if a != a.lower()])
+    svg_elements = frozenset([a.lower() for a in svg_elements])
+    svg_attr_map = dict([(a.lower(), a) for a in svg_attributes if a != a.lower()])
+    svg_attributes = frozenset([a.lower() for a in svg_attributes])
 
-    acceptable_svg_properties = [ 'fill', 'fill-opacity', 'fill-rule',
+    acceptable_svg_properties = frozenset([ 'fill', 'fill-opacity', 'fill-rule',
       'stroke', 'stroke-width', 'stroke-linecap', 'stroke-linejoin',
-      'stroke-opacity']
+      'stroke-opacity'])
+
+    # properties whose values are checked keyword by keyword
+    css_shorthand_properties = frozenset(['background', 'border', 'margin', 'padding'])
+
+    style_urls = re.compile('url\s*\(\s*[^\s)]+?\s*\)\s*')
+    style_gauntlet = re.compile("""^([:,;#%.\sa-zA-Z0-9!]|\w-\w|'[\s\w]+'|"[\s\w]+"|\([\d,\s]+\))*$""")
+    style_declaration = re.compile("\s*[-\w]+\s*:\s*[^:;]*;?")
+    style_property = re.compile("([-\w]+)\s*:\s*([^:;]*)")
+    malformed_comment_end = re.compile(r'--[^>]*>')
 
     def reset(self):
         _BaseHTMLProcessor.reset(self)
@@ -2661,18 +3058,6 @@ class _HTMLSanitizer(_BaseHTMLProcessor):
             if  self.mathmlOK and tag in self.mathml_elements:
                 acceptable_attributes = self.mathml_attributes
             elif self.svgOK and tag in self.svg_elements:
-                # for most vocabularies, lowercasing is a good idea.  Many
-                # svg elements, however, are camel case
-                if not self.svg_attr_map:
-                    lower=[attr.lower() for attr in self.svg_attributes]
-                    mix=[a for a in self.svg_attributes if a not in lower]
-                    self.svg_attributes = lower
-                    self.svg_attr_map = dict([(a.lower(),a) for a in mix])
-
-                    lower=[attr.lower() for attr in self.svg_elements]
-                    mix=[a for a in self.svg_elements if a not in lower]
-                    self.svg_elements = lower
-                    self.svg_elem_map = dict([(a.lower(),a) for a in mix])
                 acceptable_attributes = self.svg_attributes
                 tag = self.svg_elem_map.get(tag,tag)
                 keymap = self.svg_attr_map
@@ -2723,19 +3108,19 @@ class _HTMLSanitizer(_BaseHTMLProcessor):
 
     def sanitize_style(self, style):
         # disallow urls
-        style=re.compile('url\s*\(\s*[^\s)]+?\s*\)\s*').sub(' ',style)
+        style=self.style_urls.sub(' ',style)
 
         # gauntlet
-        if not re.match("""^([:,;#%.\sa-zA-Z0-9!]|\w-\w|'[\s\w]+'|"[\s\w]+"|\([\d,\s]+\))*$""", style): return ''
+        if not self.style_gauntlet.match(style): return ''
         # This replaced a regexp that used re.match and was prone to pathological back-tracking.
-        if re.sub("\s*[-\w]+\s*:\s*[^:;]*;?", '', style).strip(): return ''
+        if self.style_declaration.sub('', style).strip(): return ''
 
         clean = []
-        for prop,value in re.findall("([-\w]+)\s*:\s*([^:;]*)",style):
+        for prop,value in self.style_property.findall(style):
           if not value: continue
           if prop.lower() in self.acceptable_css_properties:
               clean.append(prop + ': ' + value + ';')
-          elif prop.split('-')[0].lower() in ['background','border','margin','padding']:
+          elif prop.split('-')[0].lower() in self.css_shorthand_properties:
               for keyword in value.split():
                   if not keyword in self.acceptable_css_keywords and \
                       not self.valid_css_values.match(keyword):
@@ -2753,23 +3138,29 @@ class _HTMLSanitizer(_BaseHTMLProcessor):
             return ret
         # if ret == -1, this may be a malicious attempt to circumvent
         # sanitization, or a page-destroying unclosed comment
-        match = re.compile(r'--[^>]*>').search(self.rawdata, i+4)
+        match = self.malformed_comment_end.search(self.rawdata, i+4)
         if match:
             return match.end()
         # unclosed comment; deliberately fail to handle_data()
         return len(self.rawdata)
 
 
-def _sanitizeHTML(htmlSource, encoding, _type):
+def _sanitizeHTML(htmlSource, encoding, _type, config=None):
     p = _HTMLSanitizer(encoding, _type)
     htmlSource = htmlSource.replace('<![CDATA[', '&lt;![CDATA[')
     p.feed(htmlSource)
-    data = p.output()
-    if TIDY_MARKUP:
+    return _tidyHTML(p.output(), config)
+
+def _tidyHTML(data, config=None):
+    if config is None:
+        tidy_markup, tidy_interfaces = TIDY_MARKUP, PREFERRED_TIDY_INTERFACES
+    else:
+        tidy_markup, tidy_interfaces = config.tidy_markup, config.preferred_tidy_interfaces
+    if tidy_markup:
         # loop through list of preferred Tidy interfaces looking for one that's installed,
         # then set up a common _tidy function to wrap the interface-specific API.
         _tidy = None
-        for tidy_interface in PREFERRED_TIDY_INTERFACES:
+        for tidy_interface in tidy_interfaces:
             try:
                 if tidy_interface == "uTidy":
                     from tidy import parseString as _utidy
@@ -2800,6 +3191,234 @@ def _sanitizeHTML(htmlSource, encoding, _type):
     data = data.strip().replace('\r\n', '\n')
     return data
 
+class _HTMLProcessor(_HTMLSanitizer, _RelativeURIResolver):
+    '''Resolve relative URIs, collect microformat links and sanitize in one pass
+
+    Each start tag is resolved and escaped exactly as _RelativeURIResolver
+    writes it out before the sanitizer sees it, so the output matches
+    _sanitizeHTML(_resolveRelativeURIs(...)) without the second parse.
+    Rel-tag, enclosure and XFN links are collected as BeautifulSoup would
+    read them back from the resolved markup; anything it might read
+    differently (vCards, markup nested in links, encodings it would have to
+    guess) sets mfFallback and is left to _parseMicroformats.  Markup the
+    resolver passes through unparsed (unclosed comments, declarations) sets
+    abnormal, and the caller falls back to the full chain.'''
+
+    # BeautifulSoup's empty elements and the elements it reads as plain text
+    soup_empty_elements = frozenset(['br', 'hr', 'input', 'img', 'link', 'frame', 'base', 'col'])
+    soup_literal_elements = frozenset(['script', 'textarea'])
+    soup_entitydefs = sgmllib.SGMLParser.entitydefs
+    soup_numeric_ref = re.compile(r'&(#\d+|#x[0-9a-fA-F]+|\w+);')
+    soup_spaces = {9: None, 10: None, 12: None, 13: None, 32: None}
+    rel_tag_match = re.compile(r'\btag\b')
+    enclosure_match = re.compile(r'\benclosure\b')
+    nonempty_match = re.compile(r'.+')
+
+    def __init__(self, baseuri, encoding, _type, microformats):
+        _BaseHTMLProcessor.__init__(self, encoding, _type)
+        self.baseuri = baseuri
+        self.microformats = microformats
+
+    def reset(self):
+        _HTMLSanitizer.reset(self)
+        self.abnormal = 0
+        self.mfFallback = 0
+        self.mfLinks = []
+        self.mfText = None
+        self.mfLiteral = {}
+        self.mfPre = 0
+
+    def parse_starttag(self, i):
+        j = sgmllib.SGMLParser.parse_starttag(self, i)
+        if self._type == 'application/xhtml+xml':
+            # the resolver writes empty elements out as <tag />
+            if j>2 and (self.rawdata[j-2:j]=='/>' or self.lasttag in self.elements_no_end_tag):
+                self.unknown_endtag(self.lasttag)
+        return j
+
+    def unknown_starttag(self, tag, attrs):
+        attrs = self.normalize_attrs(attrs)
+        attrs = [(key, ((tag, key) in self.relative_uris) and self.resolveURI(value) or value) for key, value in attrs]
+        attrs = self.escape_attrs(attrs)
+        if self.microformats:
+            self.collectStartTag(tag, attrs)
+        _HTMLSanitizer.unknown_starttag(self, tag, attrs)
+
+    def unknown_endtag(self, tag):
+        if self.microformats:
+            self.collectEndTag(tag)
+        _HTMLSanitizer.unknown_endtag(self, tag)
+
+    def handle_data(self, text):
+        if self.mfText is not None:
+            self.mfText.append(text)
+        _HTMLSanitizer.handle_data(self, text)
+
+    def handle_entityref(self, ref):
+        if name2codepoint.has_key(ref):
+            if self.mfText is not None:
+                self.mfText.append('&%s;' % ref)
+            _HTMLSanitizer.handle_entityref(self, ref)
+        else:
+            # the resolver writes this out as &amp; followed by plain text
+            self.handle_entityref('amp')
+            self.handle_data(ref)
+
+    def handle_charref(self, ref):
+        _HTMLSanitizer.handle_charref(self, ref)
+        if self.mfText is not None:
+            self.mfText.append(self.pieces[-1])
+
+    def handle_comment(self, text):
+        if self.mfText is not None:
+            self.mfFallback = 1
+        _HTMLSanitizer.handle_comment(self, text)
+
+    def handle_pi(self, text):
+        if self.microformats:
+            self.mfFallback = 1
+
+    def parse_comment(self, i, report=1):
+        ret = _BaseHTMLProcessor.parse_comment(self, i, report)
+        if ret < 0:
+            # the resolver passes the rest of the document through as text
+            self.abnormal = 1
+            return len(self.rawdata)
+        return ret
+
+    def parse_declaration(self, i):
+        self.abnormal = 1
+        return len(self.rawdata)
+
+    def _soupRef(self, match):
+        name, number, semicolon = match.groups()
+        if number:
+            if 0 <= int(number) <= 127:
+                return chr(int(number))
+            return '&#%s%s' % (number, semicolon)
+        elif semicolon:
+            return self.soup_entitydefs.get(name) or '&%s;' % name
+        return '&%s' % name
+
+    def _soupNumericRef(self, match):
+        ref = match.group(1)
+        if ref.startswith('#x'):
+            return unichr(int(ref[2:], 16))
+        elif ref.startswith('#'):
+            return unichr(int(ref[1:]))
+        return u'&%s;' % ref
+
+    def soupValue(self, value):
+        value = self.entity_or_charref.sub(self._soupRef, value)
+        return self.soup_numeric_ref.sub(self._soupNumericRef, value)
+
+    def collectStartTag(self, tag, attrs):
+        if tag in self.soup_literal_elements:
+            self.mfLiteral[tag] = self.mfLiteral.get(tag, 0) + 1
+        elif tag == 'pre':
+            self.mfPre += 1
+        elif tag == 'meta':
+            # BeautifulSoup may decode the document again
+            self.mfFallback = 1
+        if self.mfText is not None:
+            self.mfFallback = 1
+            self.mfText = None
+        attrsD = dict(attrs)
+        if attrsD.has_key('class'):
+            if attrsD['class'].find('vcard') != -1 or attrsD['class'].find('&#') != -1:
+                self.mfFallback = 1
+        if not (attrsD.has_key('rel') or attrsD.has_key('href')):
+            return
+        if (tag != 'a' and tag not in self.soup_empty_elements) or filter(None, self.mfLiteral.values()):
+            self.mfFallback = 1
+            return
+        try:
+            attrsD = dict([(key, self.soupValue(value)) for key, value in attrs])
+        except ValueError:
+            self.mfFallback = 1
+            return
+        self.mfLinks.append([attrsD, None])
+        if tag == 'a':
+            self.mfText = []
+
+    def collectEndTag(self, tag):
+        if self.mfLiteral.get(tag):
+            self.mfLiteral[tag] -= 1
+        elif tag == 'pre' and self.mfPre:
+            self.mfPre -= 1
+        if self.mfText is None:
+            return
+        text, self.mfText = ''.join(self.mfText), None
+        if tag != 'a' or text.find('<') != -1:
+            self.mfFallback = 1
+            return
+        if not text:
+            return
+        try:
+            text = unicode(text, self.encoding)
+        except:
+            self.mfFallback = 1
+            return
+        if not text.translate(self.soup_spaces):
+            if self.mfPre:
+                self.mfFallback = 1
+            elif text.find('\n') != -1:
+                text = u'\n'
+            else:
+                text = u' '
+        self.mfLinks[-1][1] = text
+
+    def findMicroformats(self):
+        if self.mfText is not None:
+            self.mfFallback = 1
+        tags, enclosures, xfn = [], [], []
+        for attrsD, string in self.mfLinks:
+            href = attrsD.get('href')
+            rel = attrsD.get('rel')
+            if rel and self.rel_tag_match.search(rel) and href:
+                tags.append(_makeRelTag(self.baseuri, href, string))
+        for attrsD, string in self.mfLinks:
+            href = attrsD.get('href')
+            if not (href and self.nonempty_match.search(href)): continue
+            if not self.enclosure_match.search(attrsD.get('rel', '')) and not _isProbablyDownloadable(attrsD): continue
+            if attrsD not in enclosures:
+                enclosures.append(attrsD)
+                if string and not attrsD.get('title'):
+                    enclosures[-1]['title'] = string
+        for attrsD, string in self.mfLinks:
+            href = attrsD.get('href')
+            rel = attrsD.get('rel')
+            if not (rel and self.nonempty_match.search(rel) and href and self.nonempty_match.search(href)): continue
+            xfn_rels = [r for r in rel.split() if r in _MicroformatsParser.known_xfn_relationships]
+            if xfn_rels:
+                xfn.append({"relationships": xfn_rels, "href": href, "name": string})
+        return {"tags": tags, "enclosures": enclosures, "xfn": xfn, "vcard": ''}
+
+_nonASCII = re.compile('[^\x00-\x7f]')
+
+def _processHTML(htmlSource, baseURI, encoding, _type, microformats, config=None):
+    '''Return the sanitized form of htmlSource with relative URIs resolved,
+    and its microformats (or None) when microformats is true'''
+    if _debug: sys.stderr.write('entering _processHTML\n')
+    p = _HTMLProcessor(baseURI, encoding, _type, microformats and BeautifulSoup)
+    if htmlSource.find('<![CDATA[') != -1:
+        p.abnormal = 1
+    else:
+        p.feed(htmlSource)
+    if p.abnormal:
+        htmlSource = _resolveRelativeURIs(htmlSource, baseURI, encoding, _type)
+        return _sanitizeHTML(htmlSource, encoding, _type, config), microformats and _parseMicroformats(htmlSource, baseURI, encoding) or None
+    mfresults = None
+    if p.microformats:
+        mfresults = p.findMicroformats()
+        if p.mfLinks and _nonASCII.search(htmlSource):
+            # BeautifulSoup only decodes the way we do when it doesn't guess
+            if type(htmlSource) != type(u'') or encoding != 'utf-8' or BeautifulSoup.chardet:
+                p.mfFallback = 1
+        if p.mfFallback:
+            mfresults = _parseMicroformats(_resolveRelativeURIs(htmlSource, baseURI, encoding, _type), baseURI, encoding)
+    return _tidyHTML(p.output(), config), mfresults
+
 class _FeedURLHandler(urllib2.HTTPDigestAuthHandler, urllib2.HTTPRedirectHandler, urllib2.HTTPDefaultErrorHandler):
     def http_error_default(self, req, fp, code, msg, headers):
         if ((code / 100) == 3) and (code != 304):
@@ -2976,10 +3595,550 @@ def _build_urllib2_request(url, agent, etag, modified, referrer, auth, request_h
     request.add_header('A-IM', 'feed') # RFC 3229 support
     return request
 
+class LRUCache:
+    '''A mapping that holds at most maxsize items
+
+    When it's full, setting a new key throws out the least recently used
+    one.  hits and misses count lookups that did and didn't find their key.
+    '''
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.clear()
+
+    def clear(self):
+        # each key maps to a [previous, next, key, value] link in a circular
+        # list running from the least to the most recently used item
+        self._links = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+        self.hits = self.misses = 0
+
+    def _moveToEnd(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+        root = self._root
+        last = root[0]
+        last[1] = root[0] = link
+        link[0] = last
+        link[1] = root
+
+    def __getitem__(self, key):
+        link = self._links.get(key)
+        if link is None:
+            self.misses += 1
+            raise KeyError, key
+        self.hits += 1
+        self._moveToEnd(link)
+        return link[3]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        link = self._links.get(key)
+        if link is not None:
+            link[3] = value
+            self._moveToEnd(link)
+            return
+        if len(self._links) >= self.maxsize:
+            oldest = self._root[1]
+            if oldest is self._root:
+                return
+            oldest[0][1] = oldest[1]
+            oldest[1][0] = oldest[0]
+            del self._links[oldest[2]]
+        root = self._root
+        last = root[0]
+        link = [last, root, key, value]
+        last[1] = root[0] = self._links[key] = link
+
+    def __delitem__(self, key):
+        link = self._links.pop(key)
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+
+    def has_key(self, key):
+        return self._links.has_key(key)
+
+    __contains__ = has_key
+
+    def __len__(self):
+        return len(self._links)
+
+    def keys(self):
+        keys = []
+        link = self._root[1]
+        while link is not self._root:
+            keys.append(link[2])
+            link = link[1]
+        return keys
+
+def _copyMicroformats(mfresults):
+    # _start_enclosure adds to the enclosure dicts it's handed, so a cached
+    # result must never give out its own
+    if not mfresults:
+        return mfresults
+    mfresults = dict(mfresults)
+    mfresults['enclosures'] = [dict(enclosure) for enclosure in mfresults.get('enclosures', [])]
+    return mfresults
+
+def _plainMicroformats(mfresults):
+    # BeautifulSoup strings drag their whole document along when pickled
+    def plain(value):
+        if isinstance(value, unicode):
+            return u'' + value
+        if isinstance(value, str):
+            return '' + value
+        if isinstance(value, dict):
+            return dict([(plain(k), plain(v)) for k, v in value.items()])
+        if isinstance(value, list):
+            return [plain(v) for v in value]
+        return value
+    if not mfresults:
+        return mfresults
+    mfresults = plain(mfresults)
+    mfresults['tags'] = [FeedParserDict(tag) for tag in mfresults.get('tags', [])]
+    return mfresults
+
+class HTMLCache:
+    '''A cache of sanitized markup shared by any number of parses
+
+    Resolving relative URIs in, parsing microformats from and sanitizing
+    htmlish content is the most expensive part of a parse, and the same
+    content comes up again and again: the same entries on every poll of a
+    feed, the same boilerplate on every entry, the same story syndicated
+    into several feeds.  Give parse() a config with an HTMLCache and the
+    processed markup is looked up by a digest of the raw markup, its content
+    type, base URI and encoding, the element it came from and the config
+    settings that change the result, so a hit gives exactly what processing
+    it again would:
+
+        config = ParserConfig(html_cache=HTMLCache(maxsize=4096))
+
+    The most recently used maxsize results are kept in memory.  If path is
+    given, results are also stored in a sqlite database there, which is
+    shared by every process using the same path and survives restarts; it
+    is pruned to about disk_maxsize results.  hits, disk_hits and misses
+    count lookups answered from memory, from disk and by processing the
+    markup; see stats().
+    '''
+    prune_interval = 1000
+
+    def __init__(self, maxsize=1024, path=None, disk_maxsize=100000):
+        self.memory = LRUCache(maxsize)
+        self.path = path
+        self.disk_maxsize = disk_maxsize
+        self.hits = self.disk_hits = self.misses = 0
+        self._db = None
+        self._pid = None
+        self._stores = 0
+
+    def key(self, parser, element, source, contenttype, baseuri):
+        '''Return the digest a piece of markup is cached under'''
+        config = parser.config
+        settings = (element in parser.can_contain_relative_uris,
+                    element in parser.can_contain_dangerous_markup,
+                    element in ['content', 'description', 'summary'],
+                    type(source) == type(u''), contenttype, baseuri,
+                    parser.encoding, config.resolve_relative_uris,
+                    config.sanitize_html, config.tidy_markup,
+                    config.tidy_markup and config.preferred_tidy_interfaces,
+                    config.parse_microformats)
+        if type(source) == type(u''):
+            source = source.encode('utf-8')
+        return _sha1(repr(settings) + '\0' + source).hexdigest()
+
+    def process(self, parser, element, source, contenttype, baseuri):
+        '''Return what parser._processMarkup returns for htmlish source,
+        from the cache if possible'''
+        key = self.key(parser, element, source, contenttype, baseuri)
+        result = self.memory.get(key)
+        if result is not None:
+            self.hits += 1
+        else:
+            result = self._load(key)
+            if result is not None:
+                self.disk_hits += 1
+                self.memory[key] = result
+        if result is None:
+            self.misses += 1
+            output, mfresults = parser._processMarkup(element, source, 1, contenttype, baseuri)
+            self.memory[key] = (output, _copyMicroformats(mfresults))
+            self._store(key, (output, mfresults))
+            return output, mfresults
+        return result[0], _copyMicroformats(result[1])
+
+    def _connect(self):
+        if self.path is None or sqlite3 is None:
+            return None
+        # sqlite connections mustn't be carried over into a forked process
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._db.text_factory = str
+            self._db.execute('CREATE TABLE IF NOT EXISTS markup (key TEXT PRIMARY KEY, value BLOB)')
+            self._pid = os.getpid()
+        return self._db
+
+    def _load(self, key):
+        try:
+            db = self._connect()
+            if db is None:
+                return None
+            row = db.execute('SELECT value FROM markup WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            return pickle.loads(str(row[0]))
+        except Exception:
+            return None
+
+    def _store(self, key, result):
+        try:
+            db = self._connect()
+            if db is None:
+                return
+            value = pickle.dumps((result[0], _plainMicroformats(result[1])), 2)
+            db.execute('INSERT OR REPLACE INTO markup (key, value) VALUES (?, ?)', (key, sqlite3.Binary(value)))
+            self._stores += 1
+            if self._stores % self.prune_interval == 0:
+                db.execute('DELETE FROM markup WHERE rowid <= (SELECT MAX(rowid) FROM markup) - ?', (self.disk_maxsize,))
+            db.commit()
+        except Exception:
+            # the disk store is only ever an optimization
+            pass
+
+    def clear(self):
+        '''Empty the cache, including the disk store, and reset the counts'''
+        self.memory.clear()
+        self.hits = self.disk_hits = self.misses = 0
+        db = self._connect()
+        if db is not None:
+            db.execute('DELETE FROM markup')
+            db.commit()
+
+    def hit_rate(self):
+        '''Return the fraction of lookups answered without processing markup'''
+        lookups = self.hits + self.disk_hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits + self.disk_hits) / lookups
+
+    def stats(self):
+        '''Return a dict of the cache's counts, size and hit rate'''
+        return {'hits': self.hits, 'disk_hits': self.disk_hits,
+                'misses': self.misses, 'size': len(self.memory),
+                'maxsize': self.memory.maxsize, 'hit_rate': self.hit_rate()}
+
 _date_handlers = []
 def registerDateHandler(func):
     '''Register a date handler function (takes string, returns 9-tuple date in GMT)'''
     _date_handlers.insert(0, func)
+
+_timings_handlers = []
+def registerTimingsHandler(func):
+    '''Register a function to be called with the href and timings of every parse
+
+    Registering a handler turns timing on for every parse (see
+    ParserConfig); the handler is called as func(href, timings) when the
+    parse is done, with the same timings that are stored in
+    result['timings'].  Exceptions raised by handlers are ignored,
+    but KeyboardInterrupt, SystemExit and eventlet.Timeout get through.
+    '''
+    _timings_handlers.append(func)
+
+# process CPU time (time.clock is wall clock time on Windows)
+_cpuTime = getattr(time, 'process_time', time.clock)
+
+class _Timings:
+    '''Wall clock time, CPU time and byte counts of each stage of a parse
+
+    stages maps each stage that was timed to a dict of its total 'wall' and
+    'cpu' seconds, the number of 'calls' and, for stages that handle data,
+    the number of 'bytes' (or characters) they handled.
+    '''
+    def __init__(self):
+        self.stages = FeedParserDict()
+        self._started = {}
+
+    def start(self, stage):
+        self._started[stage] = (time.time(), _cpuTime())
+
+    def stop(self, stage, size=None):
+        wall, cpu = self._started.pop(stage)
+        record = self.stages.get(stage)
+        if record is None:
+            record = self.stages[stage] = {'wall': 0.0, 'cpu': 0.0, 'calls': 0}
+        record['wall'] += time.time() - wall
+        record['cpu'] += _cpuTime() - cpu
+        record['calls'] += 1
+        if size is not None:
+            record['bytes'] = record.get('bytes', 0) + size
+
+# Upper bounds, in seconds, of the buckets MetricsRegistry histograms count
+# observations in; anything slower goes in a last, unbounded bucket.
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0)
+
+class _Histogram:
+    '''Counts of observations in fixed buckets, along with their count and sum'''
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, fraction):
+        '''Return the upper bound of the bucket that fraction of the
+        observations are in or under (None for the unbounded bucket)'''
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+class MetricsRegistry:
+    '''Counters and latency histograms of every parse made with it
+
+    Give parse() a config with a registry (or set METRICS to one, which
+    configs pick up when they're created) and each parse adds to these
+    counters:
+
+        parses, entries         parses, and the entries they returned
+        fetches, fetch_errors   parses of a URL, and those that didn't get
+                                a response at all
+        bytes_in                bytes downloaded, before decompression
+        status.200, status.2xx  responses by status code and by class
+        bozo, bozo.<exception>  bozo results, also by bozo_exception class
+        parser.strict           parses done by the strict parser
+        parser.loose            parses done by the loose parser, of which
+        parser.fallback         the strict parser gave up on this many
+
+    and records the time each stage of the parse took (see the timings
+    setting of ParserConfig) in a histogram named time.<stage>, such as
+    time.total, time.download and time.sanitize.  Histograms count
+    observations in fixed buckets (METRICS_BUCKETS by default), so
+    recording one is a bisect and no samples are kept.  Parses only ever
+    add to a registry; like the parser itself it isn't locked, which is
+    fine with green threads but not with OS threads sharing a registry.
+
+    snapshot() and text() report the counters, their rates per second since
+    the registry was created or reset and the histograms.  Exporters added
+    with addExporter (TextExporter, StatsdExporter) are called by the first
+    parse to finish after their interval has passed, so no thread is needed:
+
+        registry = MetricsRegistry()
+        registry.addExporter(StatsdExporter('127.0.0.1', 8125), interval=10)
+        config = ParserConfig(metrics=registry)
+
+    iter_entries() records nothing except the parse() it falls back on when
+    the streaming parser gives up.
+    '''
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._exporters = []
+        self.reset()
+
+    def reset(self):
+        '''Zero every counter and histogram'''
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def increment(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = _Histogram(self.buckets)
+        histogram.observe(value)
+
+    def rate(self, name):
+        '''Return how much a counter has gone up per second since the
+        registry was created or reset'''
+        return self.counters.get(name, 0) / max(time.time() - self.started, 1e-9)
+
+    def recordParse(self, result, stages):
+        '''Count a parse() result and record the times of its stages'''
+        increment = self.increment
+        increment('parses')
+        increment('entries', len(result['entries']))
+        status = result.get('status')
+        # the download stage is only missing if opening the URL failed
+        if status is not None or not stages.has_key('download'):
+            increment('fetches')
+            if status is None:
+                increment('fetch_errors')
+            else:
+                increment('status.%d' % status)
+                increment('status.%dxx' % (status // 100))
+                increment('bytes_in', stages['download'].get('bytes', 0))
+        if result.get('bozo'):
+            increment('bozo')
+            exception = result.get('bozo_exception')
+            if exception is not None:
+                increment('bozo.' + exception.__class__.__name__)
+        if stages.has_key('loose'):
+            increment('parser.loose')
+            if stages.has_key('strict'):
+                increment('parser.fallback')
+        elif stages.has_key('strict'):
+            increment('parser.strict')
+        for stage, record in stages.items():
+            self.observe('time.' + stage, record['wall'])
+        if self._exporters:
+            self._export(time.time())
+
+    def addExporter(self, exporter, interval=10):
+        '''Call exporter.export(registry) every interval seconds or so'''
+        self._exporters.append([exporter, interval, time.time()])
+
+    def export(self):
+        '''Call every exporter now'''
+        self._export(None)
+
+    def _export(self, now):
+        for exporter in self._exporters:
+            if now is not None and now - exporter[2] < exporter[1]:
+                continue
+            exporter[2] = now or time.time()
+            try:
+                exporter[0].export(self)
+            except Exception:
+                # metrics must never break a parse
+                pass
+
+    def snapshot(self):
+        '''Return a dict of the uptime, the counters, their rates and, for
+        each histogram, its count, sum, p50, p90, p99 and bucket counts'''
+        uptime = max(time.time() - self.started, 1e-9)
+        rates = {}
+        for name, value in self.counters.items():
+            rates[name] = value / uptime
+        histograms = {}
+        for name, histogram in self.histograms.items():
+            histograms[name] = {'count': histogram.count, 'sum': histogram.sum,
+                                'p50': histogram.percentile(0.5),
+                                'p90': histogram.percentile(0.9),
+                                'p99': histogram.percentile(0.99),
+                                'buckets': zip(self.buckets + (None,), histogram.counts)}
+        return {'uptime': uptime, 'counters': dict(self.counters),
+                'rates': rates, 'histograms': histograms}
+
+    def text(self):
+        '''Return a snapshot as text, a line for each counter and histogram'''
+        snapshot = self.snapshot()
+        counters = snapshot['counters']
+        lines = ['uptime %.1fs' % snapshot['uptime']]
+        for name in sorted(counters):
+            lines.append('%s %d (%.2f/s)' % (name, counters[name], snapshot['rates'][name]))
+        parses = counters.get('parses', 0)
+        if parses:
+            lines.append('bozo_ratio %.3f' % (float(counters.get('bozo', 0)) / parses))
+            lines.append('strict_ratio %.3f' % (float(counters.get('parser.strict', 0)) / parses))
+        for name in sorted(snapshot['histograms']):
+            histogram = snapshot['histograms'][name]
+            mean = histogram['sum'] / max(histogram['count'], 1)
+            lines.append('%s count=%d mean=%.4fs p50=%s p90=%s p99=%s' % (
+                name, histogram['count'], mean, self._formatBound(histogram['p50']),
+                self._formatBound(histogram['p90']), self._formatBound(histogram['p99'])))
+        return '\n'.join(lines) + '\n'
+
+    def _formatBound(self, bound):
+        if bound is None:
+            return '>%gs' % self.buckets[-1]
+        return '<=%gs' % bound
+
+class TextExporter:
+    '''Writes MetricsRegistry.text() to a stream (stderr by default) or, if
+    path is given, replaces the file at path with it'''
+    def __init__(self, stream=None, path=None):
+        self.stream = stream
+        self.path = path
+
+    def export(self, registry):
+        text = registry.text()
+        if self.path is None:
+            stream = self.stream or sys.stderr
+            stream.write(text)
+            stream.flush()
+            return
+        # write and rename so that readers never see half a snapshot
+        temporary = '%s.%d.tmp' % (self.path, os.getpid())
+        f = open(temporary, 'w')
+        try:
+            f.write(text)
+        finally:
+            f.close()
+        os.rename(temporary, self.path)
+
+class StatsdExporter:
+    '''Sends a MetricsRegistry's counters and histograms to statsd over UDP
+
+    Each export sends how much each counter has gone up since the last one
+    as a statsd counter (name:increase|c).  Histograms go as counters too:
+    name.count, name.sum_ms and name.le_<bound>ms for each bucket (le_inf
+    for the unbounded one, and _ for the decimal point), so the per-interval
+    counts on the statsd side add up to the histogram.  Every name starts
+    with prefix.  Lines are packed into datagrams of at most max_packet
+    bytes, and as UDP is fire and forget, errors sending them are ignored.
+    '''
+    def __init__(self, host='127.0.0.1', port=8125, prefix='feedparser.', max_packet=1432):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.max_packet = max_packet
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._last = {}
+
+    def lines(self, registry):
+        '''Return the statsd lines for what has changed since the last call'''
+        values = dict(registry.counters)
+        for name, histogram in registry.histograms.items():
+            values[name + '.count'] = histogram.count
+            values[name + '.sum_ms'] = int(histogram.sum * 1000)
+            for bound, count in zip(registry.buckets + (None,), histogram.counts):
+                if bound is None:
+                    bucket = 'inf'
+                else:
+                    bucket = ('%gms' % (bound * 1000)).replace('.', '_')
+                values['%s.le_%s' % (name, bucket)] = count
+        lines = []
+        for name in sorted(values):
+            increase = values[name] - self._last.get(name, 0)
+            if increase < 0:
+                # the registry has been reset since
+                increase = values[name]
+            if increase:
+                lines.append('%s%s:%d|c' % (self.prefix, name, increase))
+        self._last = values
+        return lines
+
+    def export(self, registry):
+        packet = ''
+        for line in self.lines(registry):
+            if packet and len(packet) + 1 + len(line) > self.max_packet:
+                self._send(packet)
+                packet = ''
+            packet = packet and packet + '\n' + line or line
+        if packet:
+            self._send(packet)
+
+    def _send(self, packet):
+        try:
+            self._socket.sendto(packet, self.address)
+        except socket.error:
+            pass
+
+    def close(self):
+        self._socket.close()
     
 # ISO-8601 date parsing routines written by Fazal Majid.
 # The ISO 8601 standard is very convoluted and irregular - a full ISO 8601
@@ -3391,22 +4550,59 @@ def _parse_date_perforce(aDateString):
 		return time.gmtime(rfc822.mktime_tz(tm))
 registerDateHandler(_parse_date_perforce)
 
-def _parse_date(dateString):
-    '''Parses a variety of date formats into a 9-tuple in GMT'''
-    for handler in _date_handlers:
-        try:
-            date9tuple = handler(dateString)
-            if not date9tuple: continue
-            if len(date9tuple) != 9:
-                if _debug: sys.stderr.write('date handler function must return 9-tuple\n')
-                raise ValueError
-            map(int, date9tuple)
-            return date9tuple
-        except Exception, e:
-            if _debug: sys.stderr.write('%s raised %s\n' % (handler.__name__, repr(e)))
-            pass
+# date strings repeat a lot across entries and polls, so parsed dates are
+# cached by (date handlers, date string)
+_date_cache = LRUCache(4096)
+
+# the shape of a date string is the string with its digits blanked out
+_date_shape = re.compile(r'\d')
+
+def _tryDateHandler(handler, dateString):
+    try:
+        date9tuple = handler(dateString)
+        if not date9tuple: return None
+        if len(date9tuple) != 9:
+            if _debug: sys.stderr.write('date handler function must return 9-tuple\n')
+            raise ValueError
+        map(int, date9tuple)
+        return date9tuple
+    except Exception, e:
+        if _debug: sys.stderr.write('%s raised %s\n' % (handler.__name__, repr(e)))
     return None
 
+def _parse_date(dateString, handlers=None, formats=None):
+    '''Parses a variety of date formats into a 9-tuple in GMT
+
+    If formats is a dict, it's used to remember which handler parsed each
+    shape of date string, and that handler is tried first for other dates of
+    the same shape.  A feed almost always sticks to one format, so this saves
+    running every date through all the handlers that can't parse it.
+    '''
+    if handlers is None:
+        handlers = _date_handlers
+    handlers = tuple(handlers)
+    key = (handlers, dateString)
+    try:
+        return _date_cache[key]
+    except KeyError:
+        pass
+    shape = learned = date9tuple = None
+    if formats is not None and dateString:
+        shape = _date_shape.sub('0', dateString)
+        learned = formats.get(shape)
+        if learned is not None and learned in handlers:
+            date9tuple = _tryDateHandler(learned, dateString)
+    if date9tuple is None:
+        for handler in handlers:
+            if handler is learned: continue
+            date9tuple = _tryDateHandler(handler, dateString)
+            if date9tuple is not None:
+                if shape is not None:
+                    formats[shape] = handler
+                break
+    _date_cache[key] = date9tuple
+    return date9tuple
+
 def _getCharacterEncoding(http_headers, xml_data):
     '''Get the character encoding of the XML document
 
@@ -3632,12 +4828,182 @@ def _stripDoctype(data):
 
     return version, data, dict(replacement and [(k.decode('utf-8'), v.decode('utf-8')) for k, v in safe_pattern.findall(replacement)])
     
-def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[], request_headers={}, response_headers={}):
+def _projectFields(fields):
+    '''Expand a list of requested entry keys into the set of keys to keep
+
+    Legacy aliases are mapped to their real keys, *_parsed and *_detail keys
+    pull in the value they're derived from, and keys that feed into another
+    key (links for link, guid for link) are kept as well.
+    '''
+    if fields is None:
+        return None
+    projection = {}
+    for key in fields:
+        key = FeedParserDict.keymap.get(key, key)
+        if type(key) == types.ListType:
+            key = key[0]
+        projection[key] = 1
+        for suffix in ('_parsed', '_detail'):
+            if key.endswith(suffix):
+                projection[key[:-len(suffix)]] = 1
+        if key in ('enclosures', 'license'):
+            projection['links'] = 1
+        elif key == 'categories':
+            projection['tags'] = 1
+        elif key == 'authors':
+            projection['author'] = 1
+    if projection.has_key('link'):
+        # the link can come from <link> or from a permalink <guid>
+        projection['links'] = 1
+        projection['id'] = 1
+    return projection
+
+class ParserConfig:
+    '''Settings for calls to parse() and iter_entries()
+
+    Settings that aren't given are copied from the module-level ones
+    (RESOLVE_RELATIVE_URIS, SANITIZE_HTML, TIDY_MARKUP,
+    PREFERRED_TIDY_INTERFACES, PREFERRED_XML_PARSERS and the handlers added
+    with registerDateHandler) when the config is created, so changing those
+    later doesn't affect it.  Parsing never modifies a config, so a single
+    instance can be shared by any number of calls and green threads:
+
+        trusted = ParserConfig(resolve_relative_uris=0, sanitize_html=0,
+                               parse_microformats=0)
+        result = parse(url, config=trusted)
+
+    fields and lazy_content work like the parse() arguments of the same name;
+    the field projection is worked out once, here.
+
+    date_formats is the one exception to configs being left alone: if it's a
+    dict, parsing records in it which date handler parsed which format of
+    date string, so that handler is tried first from then on (see
+    _parse_date).  Otherwise each parse learns the formats of its own feed.
+    Keeping a config with its own date_formats for each feed carries what's
+    been learned over from one poll to the next.
+
+    html_cache is an HTMLCache (or None) that htmlish content is looked up in
+    before it's processed; the same cache can be shared by every config.
+
+    known_ids works like the parse() argument of the same name.
+
+    timings, if true, makes parse() time each stage of the parse and store
+    the results in result['timings'] (see _Timings): 'open' (resolving the
+    host, connecting and reading the response headers), 'download',
+    'decompress', 'encoding' (detecting and converting to utf-8), 'strict'
+    and 'loose' (the strict parser and the loose one it falls back on),
+    'sanitize' (resolving relative URIs and sanitizing, along with the
+    microformats found in the same pass), 'microformats' and 'total'.
+    sanitize and microformats are part of strict or loose.  Parses that
+    aren't timed pay nothing more than a few attribute checks.
+
+    metrics is a MetricsRegistry that every parse is counted and timed in;
+    its stages are timed as with timings, but only stored in the result if
+    timings is set too.  It defaults to METRICS; give 0 to record nothing.
+    '''
+    def __init__(self, resolve_relative_uris=None, sanitize_html=None, tidy_markup=None, parse_microformats=1, preferred_xml_parsers=None, preferred_tidy_interfaces=None, date_handlers=None, fields=None, lazy_content=0, date_formats=None, html_cache=None, known_ids=None, timings=0, metrics=None):
+        def setting(value, default):
+            if value is None:
+                return default
+            return value
+        self.resolve_relative_uris = setting(resolve_relative_uris, RESOLVE_RELATIVE_URIS)
+        self.sanitize_html = setting(sanitize_html, SANITIZE_HTML)
+        self.tidy_markup = setting(tidy_markup, TIDY_MARKUP)
+        self.parse_microformats = parse_microformats
+        self.preferred_xml_parsers = tuple(setting(preferred_xml_parsers, PREFERRED_XML_PARSERS))
+        self.preferred_tidy_interfaces = tuple(setting(preferred_tidy_interfaces, PREFERRED_TIDY_INTERFACES))
+        self.date_handlers = tuple(setting(date_handlers, _date_handlers))
+        self.fields = _projectFields(fields)
+        self.lazy_content = lazy_content
+        self.date_formats = date_formats
+        self.html_cache = html_cache
+        self.known_ids = known_ids
+        self.timings = timings
+        self.metrics = setting(metrics, METRICS)
+
+    def copy(self, **settings):
+        '''Return a copy of this config with some settings changed'''
+        config = copy.copy(self)
+        for key, value in settings.items():
+            if not hasattr(self, key):
+                raise TypeError, 'unknown setting %s' % key
+            if key == 'fields':
+                value = _projectFields(value)
+            elif key in ('preferred_xml_parsers', 'preferred_tidy_interfaces', 'date_handlers'):
+                value = tuple(value)
+            setattr(config, key, value)
+        return config
+
+def _getConfig(config, fields, lazy_content, known_ids=None):
+    if config is None:
+        return ParserConfig(fields=fields, lazy_content=lazy_content, known_ids=known_ids)
+    settings = {}
+    if fields is not None:
+        settings['fields'] = fields
+    if lazy_content:
+        settings['lazy_content'] = lazy_content
+    if known_ids is not None:
+        settings['known_ids'] = known_ids
+    if settings:
+        return config.copy(**settings)
+    return config
+
+def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[], request_headers={}, response_headers={}, fields=None, lazy_content=0, config=None, known_ids=None):
     '''Parse a feed from a URL, file, stream, or string.
     
     request_headers, if given, is a dict from http header name to value to add
     to the request; this overrides internally generated values.
+
+    fields, if given, is a list of entry keys (e.g. ['title', 'link', 'id',
+    'updated_parsed']).  Entry elements that don't contribute to one of these
+    keys are still read but are neither stored nor post-processed, which
+    makes parsing considerably cheaper when only a few keys are needed.
+    Feed-level data is not affected.
+
+    lazy_content, if true, stores htmlish values as LazyContent objects whose
+    URI resolution and sanitizing only happen when their value() is first
+    read.  Content that may hold microformats is still processed up front
+    while microformats are parsed, so tags and links are complete.
+
+    known_ids, if given, is a set of entry ids and links (or a function that
+    takes an id or link and returns true for known ones).  As soon as an
+    entry's id or link turns out to be known the rest of the entry is read
+    but neither stored nor post-processed, and the entry is replaced by a
+    stub holding just its id and link (whichever were read) and known=1.
+
+    config, if given, is a ParserConfig to use instead of the module-level
+    settings; fields, lazy_content and known_ids, if given, override its own.
+    A config can also turn on timing of the stages of the parse and
+    counting parses in a metrics registry, see ParserConfig,
+    registerTimingsHandler and MetricsRegistry.
+
+    The items of entry['content'] and the *_detail values (title_detail,
+    summary_detail, ...) are ContentDetail objects, dicts which are
+    immutable: assigning to or deleting one of their keys, as in
+    entry['content'][0]['value'] = ..., raises TypeError, where it used to
+    change the dict in place.  detail.copy() or dict(detail) gives a plain
+    dict that can be changed.
     '''
+    config = _getConfig(config, fields, lazy_content, known_ids)
+    if not config.timings and not _timings_handlers and not config.metrics:
+        return _parse(url_file_stream_or_string, etag, modified, agent, referrer, handlers, request_headers, response_headers, config, None)
+
+    timings = _Timings()
+    timings.start('total')
+    result = _parse(url_file_stream_or_string, etag, modified, agent, referrer, handlers, request_headers, response_headers, config, timings)
+    timings.stop('total')
+    if config.timings or _timings_handlers:
+        result['timings'] = timings.stages
+        for handler in _timings_handlers:
+            try:
+                handler(result.get('href', ''), result['timings'])
+            except Exception:
+                pass
+    if config.metrics:
+        config.metrics.recordParse(result, timings.stages)
+    return result
+
+def _parse(url_file_stream_or_string, etag, modified, agent, referrer, handlers, request_headers, response_headers, config, timings):
     result = FeedParserDict()
     result['feed'] = FeedParserDict()
     result['entries'] = []
@@ -3650,8 +5016,12 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
     # outside of the with statement
     with eventlet.Timeout(15, False):
         try:
+            if timings is not None: timings.start('open')
             f = _open_resource(url_file_stream_or_string, etag, modified, agent, referrer, handlers, request_headers)
+            if timings is not None: timings.stop('open')
+            if timings is not None: timings.start('download')
             data = f.read()
+            if timings is not None: timings.stop('download', len(data))
         except eventlet.Timeout, e:
             result['bozo'] = 1
             result['bozo_exception'] = e
@@ -3677,6 +5047,7 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
 
     # if feed is gzip-compressed, decompress it
     if f and data and 'headers' in result:
+        if timings is not None: timings.start('decompress')
         if gzip and result['headers'].get('content-encoding') == 'gzip':
             try:
                 data = gzip.GzipFile(fileobj=_StringIO(data)).read()
@@ -3695,6 +5066,7 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
                 result['bozo'] = 1
                 result['bozo_exception'] = e
                 data = ''
+        if timings is not None: timings.stop('decompress', len(data))
 
     # save HTTP headers
     if 'headers' in result:
@@ -3705,7 +5077,7 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
         if 'last-modified' in result['headers'] or 'Last-Modified' in result['headers']:
             modified = result['headers'].get('last-modified', result['headers'].get('Last-Modified'))
             if modified:
-                result['modified'] = _parse_date(modified)
+                result['modified'] = _parse_date(modified, config.date_handlers)
     if hasattr(f, 'url'):
         result['href'] = f.url
         result['status'] = 200
@@ -3720,6 +5092,7 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
     # - sniffed_encoding is the encoding sniffed from the first 4 bytes of the XML data
     # - result['encoding'] is the actual encoding, as per RFC 3023 and a variety of other conflicting specifications
     http_headers = result.get('headers', {})
+    if timings is not None: timings.start('encoding')
     result['encoding'], http_encoding, xml_encoding, sniffed_xml_encoding, acceptable_content_type = \
         _getCharacterEncoding(http_headers, data)
     if http_headers and (not acceptable_content_type):
@@ -3732,6 +5105,7 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
 
     if data is not None:
         result['version'], data, entities = _stripDoctype(data)
+    if timings is not None: timings.stop('encoding')
 
     # ensure that baseuri is an absolute uri using an acceptable URI scheme
     contentloc = http_headers.get('content-location', http_headers.get('Content-Location', ''))
@@ -3752,6 +5126,7 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
         return result
 
     # determine character encoding
+    if timings is not None: timings.start('encoding')
     use_strict_parser = 0
     known_encoding = 0
     tried_encodings = []
@@ -3817,13 +5192,16 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
             'document declared as %s, but parsed as %s' % \
             (result['encoding'], proposed_encoding))
         result['encoding'] = proposed_encoding
+    if timings is not None: timings.stop('encoding', len(data))
 
     if not _XML_AVAILABLE:
         use_strict_parser = 0
     if use_strict_parser:
         # initialize the SAX parser
         feedparser = _StrictFeedParser(baseuri, baselang, 'utf-8')
-        saxparser = xml.sax.make_parser(PREFERRED_XML_PARSERS)
+        feedparser._setConfig(config)
+        feedparser.timings = timings
+        saxparser = xml.sax.make_parser(list(config.preferred_xml_parsers))
         saxparser.setFeature(xml.sax.handler.feature_namespaces, 1)
         saxparser.setContentHandler(feedparser)
         saxparser.setErrorHandler(feedparser)
@@ -3833,8 +5211,12 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
             # work around bug in built-in SAX parser (doesn't recognize xml: namespace)
             # PyXML doesn't have this problem, and it doesn't have _ns_stack either
             saxparser._ns_stack.append({'http://www.w3.org/XML/1998/namespace':'xml'})
+        if timings is not None: timings.start('strict')
         try:
-            saxparser.parse(source)
+            try:
+                saxparser.parse(source)
+            finally:
+                if timings is not None: timings.stop('strict', len(data))
         except Exception, e:
             if _debug:
                 import traceback
@@ -3846,13 +5228,270 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
             use_strict_parser = 0
     if not use_strict_parser:
         feedparser = _LooseFeedParser(baseuri, baselang, 'utf-8', entities)
+        feedparser._setConfig(config)
+        feedparser.timings = timings
+        if timings is not None: timings.start('loose')
         feedparser.feed(data.decode('utf-8', 'replace'))
+        if timings is not None: timings.stop('loose', len(data))
     result['feed'] = feedparser.feeddata
     result['entries'] = feedparser.entries
     result['version'] = result['version'] or feedparser.version
     result['namespaces'] = feedparser.namespacesInUse
     return result
 
+# Size of each read when streaming entries with iter_entries()
+STREAM_CHUNK_SIZE = 16384
+
+class _EntryIterator:
+    '''Iterator returned by iter_entries()
+
+    Entries are yielded as soon as their end tag has been processed.  Feed
+    level data is collected in self.feed as the document is read, so by the
+    time the first entry is yielded everything that precedes it in the
+    document (title, link, subtitle, ...) is available.  The bozo, status,
+    headers, href, encoding and version attributes mirror the keys of the
+    same name that parse() returns.
+
+    Calling close() (or abandoning the iterator) stops reading and closes
+    the underlying stream or socket.
+    '''
+    def __init__(self, url_file_stream_or_string, etag, modified, agent, referrer, handlers, request_headers, response_headers, config):
+        self.feed = FeedParserDict()
+        self.bozo = 0
+        self.bozo_exception = None
+        self.headers = {}
+        self.status = None
+        self.href = None
+        self.encoding = ''
+        self.version = ''
+        self.namespaces = {}
+        self._args = (url_file_stream_or_string, etag, modified, agent, referrer, handlers, request_headers)
+        self._response_headers = response_headers
+        self._config = config
+        self._gen = self._iterEntries()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self._gen.next()
+    __next__ = next
+
+    def close(self):
+        self._gen.close()
+
+    def _fail(self, e):
+        if not self.bozo:
+            self.bozo = 1
+            self.bozo_exception = e
+
+    def _read(self, f, decompressor):
+        with eventlet.Timeout(15):
+            chunk = f.read(STREAM_CHUNK_SIZE)
+        if decompressor:
+            if chunk:
+                chunk = decompressor.decompress(chunk)
+            else:
+                chunk = decompressor.flush()
+        return chunk
+
+    def _getDecoder(self, head, candidates, sniffed_xml_encoding):
+        # a sniffed byte order wins over the declared encoding, as in _toUTF8
+        for proposed_encoding in candidates:
+            if not proposed_encoding: continue
+            try:
+                decoder = codecs.getincrementaldecoder(sniffed_xml_encoding or proposed_encoding)('strict')
+                text = decoder.decode(head)
+            except Exception:
+                continue
+            return proposed_encoding, decoder, text
+        return None, None, None
+
+    def _iterEntries(self):
+        url_file_stream_or_string, etag, modified, agent, referrer, handlers, request_headers = self._args
+        if not isinstance(handlers, list):
+            handlers = [handlers]
+        f = None
+        try:
+            try:
+                with eventlet.Timeout(15):
+                    f = _open_resource(url_file_stream_or_string, etag, modified, agent, referrer, handlers, request_headers)
+            except (eventlet.Timeout, Exception), e:
+                self._fail(e)
+                return
+
+            if hasattr(f, 'headers'):
+                self.headers = dict(f.headers)
+            self.headers.update(self._response_headers)
+            if hasattr(f, 'url'):
+                self.href = f.url
+                self.status = 200
+            if hasattr(f, 'status'):
+                self.status = f.status
+            if self.status == 304:
+                return
+
+            decompressor = None
+            if gzip and zlib and self.headers.get('content-encoding') == 'gzip':
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            elif zlib and self.headers.get('content-encoding') == 'deflate':
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+            rawchunks = []
+            yielded = 0
+            try:
+                # sniffing the character encoding needs the whole XML
+                # declaration, so read up to the first element (or a few KB
+                # for encodings that aren't ASCII-compatible)
+                head = _s2bytes('')
+                while len(head) < 4096 and not re.search(_s2bytes('<\w'), head):
+                    chunk = self._read(f, decompressor)
+                    if not chunk:
+                        break
+                    rawchunks.append(chunk)
+                    head = head + chunk
+
+                self.encoding, http_encoding, xml_encoding, sniffed_xml_encoding, acceptable_content_type = \
+                    _getCharacterEncoding(self.headers, head)
+                if self.headers and (not acceptable_content_type):
+                    content_type = self.headers.get('content-type', self.headers.get('Content-type'))
+                    if content_type:
+                        self._fail(NonXMLContentType('%s is not an XML media type' % content_type))
+                    else:
+                        self._fail(NonXMLContentType('no Content-type specified'))
+
+                # only encodings we can decode incrementally are streamed;
+                # anything else goes through the full parse() machinery
+                proposed_encoding, decoder, text = self._getDecoder(head,
+                    (self.encoding, xml_encoding, sniffed_xml_encoding), sniffed_xml_encoding)
+                if decoder is None or not _XML_AVAILABLE:
+                    raise CharacterEncodingUnknown('cannot stream %s data' % self.encoding)
+                if proposed_encoding != self.encoding:
+                    self._fail(CharacterEncodingOverride('document declared as %s, but parsed as %s' % (self.encoding, proposed_encoding)))
+                    self.encoding = proposed_encoding
+
+                # strip the BOM and rewrite the XML declaration, then read
+                # until we've seen the first element so that the doctype can
+                # be stripped
+                if text[:1] == u'\ufeff':
+                    text = text[1:]
+                declmatch = re.compile(u'^<\?xml[^>]*?>')
+                newdecl = u'''<?xml version='1.0' encoding='utf-8'?>'''
+                if declmatch.search(text):
+                    text = declmatch.sub(newdecl, text)
+                else:
+                    text = newdecl + u'\n' + text
+                data = text.encode('utf-8')
+                while not re.search(_s2bytes('<\w'), data):
+                    chunk = self._read(f, decompressor)
+                    if not chunk:
+                        break
+                    rawchunks.append(chunk)
+                    data = data + decoder.decode(chunk).encode('utf-8')
+                version, data, entities = _stripDoctype(data)
+                self.version = version or ''
+
+                contentloc = self.headers.get('content-location', self.headers.get('Content-Location', ''))
+                href = self.href or ''
+                baseuri = _makeSafeAbsoluteURI(href, contentloc) or _makeSafeAbsoluteURI(contentloc) or href
+                baselang = self.headers.get('content-language', self.headers.get('Content-Language', None))
+                parser = _StrictFeedParser(baseuri, baselang, 'utf-8')
+                parser._setConfig(self._config)
+                parser.feeddata = self.feed
+                if baselang:
+                    self.feed['language'] = baselang.replace('_','-')
+                self.namespaces = parser.namespacesInUse
+                saxparser = xml.sax.make_parser(list(self._config.preferred_xml_parsers))
+                saxparser.setFeature(xml.sax.handler.feature_namespaces, 1)
+                saxparser.setContentHandler(parser)
+                saxparser.setErrorHandler(parser)
+                if hasattr(saxparser, '_ns_stack'):
+                    # work around bug in built-in SAX parser (doesn't recognize xml: namespace)
+                    saxparser._ns_stack.append({'http://www.w3.org/XML/1998/namespace':'xml'})
+
+                while 1:
+                    if data:
+                        try:
+                            saxparser.feed(data)
+                        except Exception, e:
+                            raise parser.exc or e
+                    self.version = self.version or parser.version
+                    complete = len(parser.entries) - (parser.inentry and 1 or 0)
+                    if complete > 0:
+                        entries = parser.entries[:complete]
+                        # completed entries are never touched again, so drop
+                        # our reference to them as they're handed out
+                        del parser.entries[:complete]
+                        for entry in entries:
+                            yielded += 1
+                            yield entry
+                    chunk = self._read(f, decompressor)
+                    if not chunk:
+                        break
+                    rawchunks.append(chunk)
+                    data = decoder.decode(chunk).encode('utf-8')
+                try:
+                    saxparser.close()
+                except Exception, e:
+                    raise parser.exc or e
+                self.version = self.version or parser.version
+                for entry in parser.entries:
+                    yielded += 1
+                    yield entry
+                return
+            except eventlet.Timeout, e:
+                self._fail(e)
+                return
+            except Exception, e:
+                if _debug: sys.stderr.write('streaming xml parsing failed: %s\n' % repr(e))
+                if not isinstance(e, CharacterEncodingUnknown):
+                    self._fail(e)
+
+            # the strict streaming parser gave up; read whatever is left and
+            # run the whole document through parse(), which knows how to fall
+            # back to the loose parser, skipping the entries already yielded
+            try:
+                while 1:
+                    chunk = self._read(f, decompressor)
+                    if not chunk:
+                        break
+                    rawchunks.append(chunk)
+            except eventlet.Timeout, e:
+                self._fail(e)
+                return
+            headers = dict(self.headers)
+            headers.pop('content-encoding', None)
+            # the data is handed over as a string, so pass the feed's URL on
+            # as its content location for relative URIs to be resolved against
+            contentloc = headers.pop('content-location', headers.pop('Content-Location', ''))
+            href = self.href or ''
+            headers['content-location'] = _makeSafeAbsoluteURI(href, contentloc) or _makeSafeAbsoluteURI(contentloc) or href
+            result = parse(_s2bytes('').join(rawchunks), response_headers=headers, config=self._config)
+            for key, value in result['feed'].items():
+                self.feed.setdefault(key, value)
+            if result.get('bozo'):
+                self._fail(result.get('bozo_exception'))
+            self.encoding = result.get('encoding', self.encoding)
+            self.version = result.get('version') or self.version
+            self.namespaces = result.get('namespaces', self.namespaces)
+            for entry in result['entries'][yielded:]:
+                yield entry
+        finally:
+            if f is not None and hasattr(f, 'close'):
+                f.close()
+
+def iter_entries(url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[], request_headers={}, response_headers={}, fields=None, lazy_content=0, config=None, known_ids=None):
+    '''Parse a feed from a URL, file, stream, or string, one entry at a time.
+
+    Takes the same arguments as parse() and returns an iterator of entries.
+    Each entry is yielded as soon as its end tag has been parsed, so callers
+    that only need the newest few entries can stop early; closing the
+    iterator aborts the parse and closes the connection.  Feed-level data
+    is available as the iterator's feed attribute.
+    '''
+    config = _getConfig(config, fields, lazy_content, known_ids)
+    return _EntryIterator(url_file_stream_or_string, etag, modified, agent, referrer, handlers, request_headers, response_headers, config)
+
 class Serializer:
     def __init__(self, results):
         self.results = results
@@ -27,11 +27,22 @@ import warnings
 import copy
 import pprint
 import urllib
+import urlparse
+import re
 from eventlet.green import urllib2 as urllib2
 import eventlet
 import socket
 import httplib
 import random
+import zlib
+import os
+import hashlib
+import sqlite3
+import math
+import mmap
+import struct
+import fcntl
+import inspect
 
 
 class SmartFeedParserDict:
@@ -42,6 +53,101 @@ class SmartFeedParserDict:
     depending upon the protocol of the feed we're crawling
     """
 
+    # Wrapped children of a lazily wrapped object, None unless lazy
+    _lazy_cache = None
+
+    # Values of computed keys we've already worked out, and the
+    # update_time_format they were worked out with
+    _memo = None
+    _memo_format = None
+
+    # Computed keys whose values can't be reused so are never memoized
+    unmemoized_keys = ("source_unescaped_html",)
+
+    # Computed keys added with register_field, mapping a key to a function
+    # that takes the object and returns the value. Each class that registers
+    # a field gets a dict of its own, see L{getters}
+    computed_fields = {}
+
+    # The classes whose getters have been worked out, register_field throws
+    # their tables away so they're worked out again
+    _getter_classes = []
+
+    # "_get_<name>" for each key read so far, so __getitem__ can look for a
+    # _get_ method set on the object without building the name every time
+    _getter_attributes = {}
+
+    # Computed keys added to this one object with create_item
+    _instance_fields = None
+
+    @classmethod
+    def register_field(cls, name, func):
+        """
+        Adds a computed key to every instance of this class (and of its
+        subclasses that don't register their own). Registering costs nothing
+        per object, so it's the way to attach a custom field to a large
+        number of stories. Subclasses get a registry of their own the first
+        time they register a field, so a pipeline can subclass
+        SmartFeedParserDict to keep its fields to itself.
+
+        >>> class Pipeline(SmartFeedParserDict):
+        ...     pass
+        >>> Pipeline.register_field('shouting',
+        ...                         lambda story: story['title'].upper())
+        >>> Pipeline({'title': 'Apple'})['shouting']
+        'APPLE'
+        >>> 'shouting' in SmartFeedParserDict({'title': 'Apple'})
+        False
+
+        @param name: the key the value is read with
+        @param func: a function taking the object and returning the value
+        """
+        if not callable(func):
+            raise TypeError("%s is defined to be a non callable method" % name)
+
+        if "computed_fields" not in cls.__dict__:
+            cls.computed_fields = {}
+        cls.computed_fields[name] = func
+        for klass in SmartFeedParserDict._getter_classes:
+            del klass._getter_map
+        del SmartFeedParserDict._getter_classes[:]
+
+    @classmethod
+    def getters(cls):
+        """
+        Returns the computed keys of the class, mapping each one to the
+        function that works it out. Those are the _get_<name> methods of the
+        class and of its bases, along with the fields registered on them with
+        L{register_field}. A class's methods and fields win over its bases',
+        and a field registered on a class wins over its own method. This is
+        worked out the first time a class is used and again after a field has
+        been registered anywhere, so a subclass only has to define its
+        _get_ methods
+
+        >>> class Shouting(SmartFeedParserDict):
+        ...     def _get_title(self):
+        ...         return self.__feed_dict__['title'].upper()
+        ...     def _get_initial(self):
+        ...         return self['title'][0]
+        >>> Shouting({'title': 'apple'})['title']
+        'APPLE'
+        >>> Shouting({'title': 'apple'})['initial']
+        'A'
+        """
+        getters = cls.__dict__.get("_getter_map")
+        if getters is not None:
+            return getters
+
+        getters = {}
+        for klass in reversed(inspect.getmro(cls)):
+            for attr_name, func in klass.__dict__.items():
+                if attr_name.startswith("_get_") and callable(func):
+                    getters[attr_name[len("_get_"):]] = func
+            getters.update(klass.__dict__.get("computed_fields", {}))
+        cls._getter_map = getters
+        SmartFeedParserDict._getter_classes.append(cls)
+        return getters
+
     def create_item(self, name, func, *args, **kwargs):
         """
         This function allows users to create a user defined function to be
@@ -77,18 +183,62 @@ class SmartFeedParserDict:
         >>> result['foo']
         'cooler than, some element of any type'
 
+        The function is given the object as it was when create_item was
+        called, keys set on the object afterwards don't change what it sees
+
+        >>> story = SmartFeedParserDict({'summary': 'a',
+        ...                              'links': [{'href': 'http://a/'}]})
+        >>> story['link']
+        'http://a/'
+        >>> story.create_item('both',
+        ...                   lambda v_: v_['summary'] + ' ' + v_['link'])
+        >>> story['summary'] = 'b'
+        >>> story['links'] = [{'href': 'http://b/'}]
+        >>> story['both']
+        'a http://a/'
+
         @param name: The name of the element that we want to be associated with
             a function This function can be a filter or a complete replacement
             for this value
         @param func: The filter / replacement function for this key
         """
-        self_ = copy.deepcopy(self)
-
-        def closure():
-            return func(self_, *args, **kwargs)
-
-        return setattr(self, self.__special_extended_item_method_name(name),
-                       closure)
+        # The function is handed a copy of the object as it was before this
+        # key was added, which is what lets it build on the previous value
+        # of the key. The copy has its own keys, memoized values and wrapped
+        # children, so keys set, updated or deleted on the object later on
+        # don't show through, but nested values changed in place do
+        self_ = copy.copy(self)
+        self_.__feed_dict__ = copy.copy(self.__feed_dict__)
+        if self._memo is not None:
+            self_._memo = dict(self._memo)
+        if self._lazy_cache is not None:
+            self_._lazy_cache = dict(self._lazy_cache)
+
+        self._instance_fields = dict(self._instance_fields or {})
+        self._instance_fields[name] = \
+            lambda obj_: func(self_, *args, **kwargs)
+
+        self.forget()
+
+    def forget(self):
+        """
+        Throws away the memoized values of computed keys like "stories",
+        "content" and "update_time" so they're worked out again the next
+        time they're read. Setting, updating and deleting keys does this
+        for us, call it after changing a nested element in place
+
+        >>> story = SmartFeedParserDict({'links': [{'href': 'http://a/'}]})
+        >>> story["link"]
+        'http://a/'
+        >>> story["links"][0]["href"] = 'http://b/'
+        >>> story["link"]
+        'http://a/'
+        >>> story.forget()
+        >>> story["link"]
+        'http://b/'
+        """
+        if self._memo is not None:
+            self._memo = None
 
     def get(self, name, default):
         """
@@ -148,6 +298,7 @@ class SmartFeedParserDict:
             self.safe_delete(elm)
 
         self.__feed_dict__.update(update_dict)
+        self.forget()
 
     def iteritems(self):
         """
@@ -206,7 +357,7 @@ class SmartFeedParserDict:
 
     def __init__(self, feedparserdict=None,
                  update_time_format="%Y-%m-%dT%H:%M:%SZ",
-                 encoding_func=None, fuzz_update_time=1):
+                 encoding_func=None, fuzz_update_time=1, lazy=False):
         """
         Takes a feedparserdict as an argument and returns an instance of
         SmartFeedParserDict.
@@ -223,6 +374,9 @@ class SmartFeedParserDict:
             time.strftime() which will determine the ouput format when calling
             story["update_time"]
         @param encoding_func: An encoding function to filter returned strings
+        @param lazy: (optional) if True nested dictionaries and lists in
+            feedparserdict are only wrapped when they're read, see
+            L{make_smart_object}
         @type feedparserdict: FeedParserDict
         """
 
@@ -241,6 +395,9 @@ class SmartFeedParserDict:
                                  "be an integer greater than 1")
         self.fuzz_update_time = fuzz_update_time
 
+        if lazy:
+            self._lazy_cache = {}
+
     def _get_link(self):
         """
         In an *intelligent* way get the link for the story
@@ -257,6 +414,16 @@ class SmartFeedParserDict:
         # If that fails, print self and dump nothing
         return ""
 
+    def _get_canonical_link(self):
+        """
+        The story's link in canonical form, see L{smart_canonical_link},
+        using feedburner's original link when there is one. This is the link
+        to dedup stories and cache pages by
+        """
+        link = self.__feed_dict__.get("feedburner_origlink", None) or \
+            self["link"]
+        return self.escape(smart_canonical_link(link))
+
     def _get_source_unescaped_html(self):
         """
         For a given element having the attribute 'link' this method returns
@@ -298,8 +465,9 @@ class SmartFeedParserDict:
         Sometimes the update time is missing or in some pathelogical cases the
         update time is set to some time in the future. This call takes care
         of those issues. If the update time is missing then we assume that it's
-        the gmtime. Also, if the time we find is newer than the current
-        gmtime then we return the update time as now.
+        the time the feed was fetched. Also, if the time we find is newer than
+        the time the feed was fetched then we return that instead. The time is
+        formatted from the story's update_epoch.
 
         >>> # prints the update time of the first story in ISO 8601 format
         >>> result = smart_parse('http://reddit.com/.rss')
@@ -327,38 +495,42 @@ class SmartFeedParserDict:
         if self.__feed_dict__.has_key("update_time"):
             return self.__feed_dict__["update_time"]
 
-        # Attempt to parse the time from the feed
-        try:
-            update_time = time.strftime(self.update_time_format,
-                                        self.__feed_dict__["updated_parsed"])
-        except (TypeError, KeyError):
-            # If the story doesn't have an update time give it an update time
-            # of now minus a random number of seconds up to fuzz_update_time
-            # this lets us reasonably guarantee that if
-            # we crawl a feed with many missing story times that the times
-            # don't clobber one another in a list of story update times
-            # by default the fuzz update time is 0
-            fuzz = random.randint(-1 * int(self.fuzz_update_time), int(self.fuzz_update_time))
-            update_time = time.strftime(self.update_time_format,
-                                        time.gmtime(time.time() + fuzz))
-
-        # Make sure that the time isn't more recent than right now to outsmart
-        # wouldbe tricksters
-        # TODO: right a test to validate this functionality
-        try:
-            elm_epoch_time = calendar.timegm(
-                time.strptime(update_time, self.update_time_format))
-        except ValueError, e:
-            elm_epoch_time = time.time() + 5
+        return time.strftime(self.update_time_format,
+                             time.gmtime(self["update_epoch"]))
+
+    def _get_update_epoch(self):
+        """
+        The update time of the story in seconds since the epoch, see
+        L{smart_update_epoch}. smart_parse works this out for every story
+        when the feed is fetched, otherwise it's worked out when it's first
+        read. Because it's an integer sorting and comparing stories by it
+        is cheap
+
+        >>> result = smart_parse('http://reddit.com/.rss')
+        >>> stories = sorted(result["stories"],
+        ...                  key=lambda story: story["update_epoch"])
+        """
+        if "update_epoch" in self.__feed_dict__:
+            return self.__feed_dict__["update_epoch"]
 
-        if int(elm_epoch_time) > int(time.time()):
-            update_time = time.strftime(self.update_time_format, time.gmtime())
+        return smart_update_epoch(self.__feed_dict__.get("updated_parsed"),
+                                  self.fuzz_update_time,
+                                  identifier=smart_story_identifier(
+                                      self.__feed_dict__))
 
-        # Don't go through all this logic if we ask for the update time again
-        # The update time shouldn't be changing from one call to another
-        self.update_time = update_time
+    def _get_fingerprint(self):
+        """
+        A 64 bit integer identifying the story, see L{smart_fingerprint}.
+        smart_parse works this out for every story when the feed is parsed,
+        otherwise it's worked out when it's first read
+        """
+        if "fingerprint" in self.__feed_dict__:
+            return self.__feed_dict__["fingerprint"]
 
-        return update_time
+        fingerprint = smart_fingerprint(self.__feed_dict__)
+        if fingerprint is None:
+            raise KeyError("fingerprint")
+        return fingerprint
 
     def __len__(self):
         return len(self.__dict__)
@@ -378,9 +550,9 @@ class SmartFeedParserDict:
         if "title" in self.__feed_dict__:
             return self.__feed_dict__.get("title")
         elif "feed" in self.__feed_dict__ and (
-                SmartFeedParserDict == self.__feed_dict__["feed"].__class__
+                SmartFeedParserDict == self.get("feed", None).__class__
             ):
-            return self.__feed_dict__["feed"].get("title", None)
+            return self.get("feed", None).get("title", None)
         else:
             return None
 
@@ -490,23 +662,60 @@ class SmartFeedParserDict:
         >>> stories = result["stories"]
 
 
+        Computed keys are only worked out once, until the object is changed
+        through __setitem__, update or __delitem__ (or L{forget} is called)
+
+        >>> result = smart_parse('http://reddit.com/.rss')
+        >>> result["stories"] is result["stories"]
+        True
+
         @class_variable L{encoding_func}: a function to escape strings with
         """
 
-        special_method_name = self.__special_extended_item_method_name(name)
+        if self._memo is not None and name in self._memo:
+            if self._memo_format == self.update_time_format:
+                return self._memo[name]
+            self.forget()
+
+        attr_name = self._getter_attributes.get(name)
+        if attr_name is None:
+            attr_name = self._getter_attributes[name] = "_get_" + name
+
+        if self._instance_fields is not None and name in self._instance_fields:
+            getter = self._instance_fields[name]
+        elif attr_name in self.__dict__:
+            # a _get_<name> set on the object itself is called without
+            # arguments
+            method = self.__dict__[attr_name]
+            if not callable(method):
+                raise AttributeError("%s is defined to be a non "
+                                     "callable method" % attr_name)
+            getter = lambda obj_: method()
+        else:
+            getters = self.__class__.__dict__.get("_getter_map")
+            if getters is None:
+                getters = self.getters()
+            getter = getters.get(name)
 
-        if hasattr(self, special_method_name):
-            attr = getattr(self, special_method_name)
-            if callable(attr):
-                result = attr()
-            else:
-                raise AttributeError("%s is defined to be a non callable method" % special_method_name)
+        if getter is not None:
+            result = getter(self)
+
+            if name not in self.unmemoized_keys:
+                result = self.__memoize(name, result)
         else:
             if name in self.__feed_dict__:
                 result = self.__feed_dict__[name]
             else:
                 raise KeyError(name)
 
+            if self._lazy_cache is not None:
+                result = self.__lazy_child(name, result)
+
+        # Content parsed with lazy_content is only sanitized once we
+        # actually ask for it, the result is memoized by the LazyContent
+        if isinstance(result, feedparser.LazyContent):
+            result = result.value()
+
         return SmartFeedParserDict.escape(result)
 
     def __delitem__(self, name):
@@ -525,17 +734,47 @@ class SmartFeedParserDict:
         @param name: the name of the element you wish to delete
         """
 
-        if hasattr(self, self.__special_extended_item_method_name(name)):
-            delattr(self, self.__special_extended_item_method_name(name))
+        if self._instance_fields is not None and name in self._instance_fields:
+            del self._instance_fields[name]
+
+        elif "_get_" + name in self.__dict__:
+            del self.__dict__["_get_" + name]
 
         elif name in self.__feed_dict__:
             del self.__feed_dict__[name]
+            if self._lazy_cache is not None:
+                self._lazy_cache.pop(name, None)
 
         else:
             raise KeyError(name)
 
-    def __special_extended_item_method_name(self, name):
-        return "_get_%s" % name
+        self.forget()
+
+    def __memoize(self, name, result):
+        if isinstance(result, feedparser.LazyContent):
+            result = result.value()
+        result = SmartFeedParserDict.escape(result)
+
+        if self._memo is None:
+            self._memo = {}
+            self._memo_format = self.update_time_format
+        self._memo[name] = result
+
+        return result
+
+    def __lazy_child(self, name, value):
+        """
+        Wraps a child of a lazily wrapped object the first time it's read and
+        hands back the same wrapped child after that
+        """
+        if name in self._lazy_cache:
+            return self._lazy_cache[name]
+
+        if hasattr(value, 'keys') or type(value) == list:
+            value = make_smart_object(value, lazy=True)
+            self._lazy_cache[name] = value
+
+        return value
 
     def __setitem__(self, name, value):
         """
@@ -570,6 +809,10 @@ class SmartFeedParserDict:
         """
 
         self.__feed_dict__[name] = value
+        if self._lazy_cache is not None:
+            self._lazy_cache.pop(name, None)
+        self.forget()
+
 
 
 def make_smart_object(obj_, *args, **kwargs):
@@ -602,11 +845,40 @@ def make_smart_object(obj_, *args, **kwargs):
 
     >>> type(smrt['b'][0])
     <type 'instance'>
+
+    Converting every nested element up front costs time for elements nobody
+    reads. With lazy=True the object is wrapped as is and nested
+    dictionaries and lists are only converted when they're first read, the
+    converted element is kept for later reads. Lists are copied rather than
+    converted in place
+
+    >>> elm = {'a':{'1', '2'}, 'b': [{'c': 'C'}]}
+    >>> smrt = make_smart_object(elm, lazy=True)
+    >>> type(smrt['b'][0])
+    <type 'instance'>
+    >>> smrt['b'] is smrt['b']
+    True
+    >>> type(elm['b'][0])
+    <type 'dict'>
+
+    @param lazy: (optional) wrap nested elements as they're read
     """
+    lazy = kwargs.pop("lazy", False)
 
     if type(obj_) == type(SmartFeedParserDict()):
         return obj_
 
+    # Compact stories are already normalized
+    elif isinstance(obj_, SmartEntry):
+        return obj_
+
+    # Wrap it as is, children are wrapped by __getitem__ as they're read
+    elif lazy and hasattr(obj_, 'keys'):
+        new_obj = SmartFeedParserDict(obj_, lazy=True)
+
+    elif lazy and type(obj_) == type(list()):
+        new_obj = [make_smart_object(elm, lazy=True) for elm in obj_]
+
     # This element is a dictionary like item
     elif hasattr(obj_, 'keys'):
         new_obj = SmartFeedParserDict()
@@ -626,6 +898,228 @@ def make_smart_object(obj_, *args, **kwargs):
     return new_obj
 
 
+class SmartEntry(object):
+    """
+    A compact, read only story holding only the normalized fields our
+    pipelines keep: id, fingerprint, title, link, canonical link, update
+    epoch, content, author and enclosures. A story built by make_smart_object is a SmartFeedParserDict
+    wrapping a FeedParserDict with more of them nested inside for links,
+    title_detail and so on, which adds up to several kilobytes per story.
+    A SmartEntry keeps its fields in __slots__ so large windows of stories
+    can be held in memory cheaply. The raw FeedParserDict is only kept if
+    it's asked for with keep_raw.
+
+    Fields are read like a SmartFeedParserDict, strings are utf-8 encoded:
+
+    >>> raw = feedparser.FeedParserDict({'title': u'Apple', 'id': u'1',
+    ...     'links': [feedparser.FeedParserDict({'rel': 'alternate',
+    ...         'type': 'text/html', 'href': u'http://example.com/1'})],
+    ...     'summary': u'<p>An apple</p>',
+    ...     'updated_parsed': time.gmtime(0)})
+    >>> story = SmartEntry.from_story(raw)
+    >>> story["title"], story["link"], story["content"]
+    ('Apple', 'http://example.com/1', '<p>An apple</p>')
+    >>> story["update_time"]
+    '1970-01-01T00:00:00Z'
+    >>> story.get("author", "nobody")
+    'nobody'
+    >>> story.raw is None
+    True
+    """
+    __slots__ = ("id", "fingerprint", "title", "link", "canonical_link",
+                 "update_epoch", "content", "author", "_enclosures", "raw")
+
+    # The format story["update_time"] is rendered in, subclass to change it
+    update_time_format = "%Y-%m-%dT%H:%M:%SZ"
+
+    # The keys we answer to, computed keys have a _get_<name> method
+    _keys = ("id", "fingerprint", "title", "link", "canonical_link",
+             "update_epoch", "update_time", "content", "author", "enclosures")
+
+    def __init__(self, id=None, title=None, link="", update_epoch=None,
+                 content="", author=None, enclosures=(), raw=None,
+                 fingerprint=None, canonical_link=""):
+        self.id = id
+        self.fingerprint = fingerprint
+        self.title = title
+        self.link = link
+        self.canonical_link = canonical_link
+        self.update_epoch = update_epoch
+        self.content = content
+        self.author = author
+        self._enclosures = tuple(enclosures)
+        self.raw = raw
+
+    @classmethod
+    def from_story(cls, story, keep_raw=False, fuzz_update_time=1):
+        """
+        Builds a SmartEntry from a story, either a raw feedparser entry or a
+        SmartFeedParserDict, using the same normalization the
+        SmartFeedParserDict keys do.
+
+        @param story: a FeedParserDict entry or a SmartFeedParserDict story
+        @param keep_raw: (optional) if True the raw entry is kept as
+            story.raw, otherwise it is dropped
+        @param fuzz_update_time: (optional) stories without an update time
+            are given the current time give or take this many seconds
+        @return: a SmartEntry
+        """
+        raw = story
+        if not isinstance(story, SmartFeedParserDict):
+            story = SmartFeedParserDict(story,
+                                        fuzz_update_time=fuzz_update_time)
+
+        link = story["link"]
+        enclosures = []
+        for enclosure in story.get("links", []):
+            if enclosure.get("rel", None) == "enclosure":
+                enclosures.append(
+                    (SmartFeedParserDict.escape(enclosure.get("href", None)),
+                     SmartFeedParserDict.escape(enclosure.get("type", None)),
+                     SmartFeedParserDict.escape(enclosure.get("length", None))))
+
+        return cls(id=story.get("id", None) or link or None,
+                   fingerprint=story.get("fingerprint", None),
+                   title=story.get("title", None),
+                   link=link,
+                   canonical_link=story["canonical_link"],
+                   update_epoch=story["update_epoch"],
+                   content=story["story_content"],
+                   author=story.get("author", None),
+                   enclosures=enclosures,
+                   raw=keep_raw and raw or None)
+
+    def _get_update_time(self):
+        return time.strftime(self.update_time_format,
+                             time.gmtime(self.update_epoch))
+
+    def _get_enclosures(self):
+        return [{"href": href, "type": type_, "length": length}
+                for (href, type_, length) in self._enclosures]
+
+    def __getitem__(self, name):
+        if name not in self._keys:
+            raise KeyError(name)
+        if name in ("update_time", "enclosures"):
+            return getattr(self, "_get_%s" % name)()
+        value = getattr(self, name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        try:
+            self[name]
+        except KeyError:
+            return False
+        return True
+
+    has_key = __contains__
+
+    def keys(self):
+        return [name for name in self._keys if name in self]
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return str(dict([(name, self[name]) for name in self.keys()]))
+
+    __str__ = __repr__
+
+
+def smart_update_epoch(updated_parsed, fuzz_update_time=1, fetch_time=None,
+                       identifier=""):
+    """
+    Turns a story's updated_parsed time into seconds since the epoch. Times
+    after fetch_time are clamped to it, so stories can't claim to be from
+    the future. Stories without a time are given fetch_time minus up to
+    fuzz_update_time seconds, so that a feed with many missing times
+    doesn't give all its stories the same time. The fuzz comes from a hash
+    of the story's identifier, so the same story always gets the same time.
+
+    >>> smart_update_epoch(time.gmtime(0))
+    0
+
+    >>> a = smart_update_epoch(None, 60, 1000, 'a')
+    >>> a == smart_update_epoch(None, 60, 1000, 'a'), 940 <= a <= 1000
+    (True, True)
+
+    @param updated_parsed: a time.struct_time in UTC or None
+    @param fuzz_update_time: (optional) the most seconds a missing time
+        is fuzzed by
+    @param fetch_time: (optional) when the feed was fetched in seconds since
+        the epoch, defaults to now
+    @param identifier: (optional) a string identifying the story, see
+        L{smart_story_identifier}
+    @return: an int
+    """
+    if fetch_time is None:
+        fetch_time = time.time()
+
+    try:
+        epoch = calendar.timegm(updated_parsed)
+    except (TypeError, ValueError, OverflowError):
+        if isinstance(identifier, unicode):
+            identifier = identifier.encode("utf-8", "replace")
+        fuzz = (zlib.crc32(identifier or "") & 0xffffffff) % \
+            (int(fuzz_update_time) + 1)
+        epoch = fetch_time - fuzz
+
+    if int(epoch) > int(fetch_time):
+        epoch = fetch_time
+
+    return int(epoch)
+
+
+def smart_story_identifier(story):
+    """
+    Returns the string we tell a story apart by: its id, or failing that its
+    link or title, or "" if it has none of them
+
+    >>> smart_story_identifier({'link': 'http://a/', 'title': 'A'})
+    'http://a/'
+
+    @param story: a raw feedparser entry or a dictionary like it
+    @return: a string
+    """
+    for key in ("id", "link", "title"):
+        if key in story and story[key]:
+            return story[key]
+
+    return ""
+
+
+def smart_normalize_update_times(entries, fetch_time=None, fuzz_update_time=1):
+    """
+    Works out the update_epoch of each raw feedparser entry up front, see
+    L{smart_update_epoch}. smart_parse does this with the time it fetched
+    the feed, so every story is clamped and fuzzed against the same time.
+
+    >>> entries = [{'id': '1', 'updated_parsed': time.gmtime(60)}, {'id': '2'}]
+    >>> smart_normalize_update_times(entries, fetch_time=120)
+    >>> [entry['update_epoch'] for entry in entries]
+    [60, 119]
+
+    @param entries: a list of raw feedparser entries, modified in place
+    @param fetch_time: (optional) when the feed was fetched, defaults to now
+    @param fuzz_update_time: (optional) see L{smart_update_epoch}
+    """
+    if fetch_time is None:
+        fetch_time = time.time()
+
+    for entry in entries:
+        entry["update_epoch"] = smart_update_epoch(
+            entry.get("updated_parsed"), fuzz_update_time, fetch_time,
+            smart_story_identifier(entry))
+
+
 def return_longest_list_element(list_):
     """
     Takes a list as an argument and returns the longest element in that list.
@@ -780,9 +1274,156 @@ def smart_url_protocol_guesser(url):
     return url
 
 
+# The raw feedparser keys that each of our normalized story keys is built from
+SMART_FIELD_SOURCES = {
+    "link": ["link"],
+    "content": ["content", "description", "summary"],
+    "update_time": ["updated_parsed", "id"],
+    "update_epoch": ["updated_parsed", "id"],
+    "source_unescaped_html": ["links"],
+    "canonical_link": ["link", "feedburner_origlink"],
+    "fingerprint": ["id", "link", "feedburner_origlink", "title",
+                    "published", "updated", "content", "summary"],
+}
+
+
+def smart_fields(fields):
+    """
+    Translates a list of story keys, which may include our normalized keys
+    like 'update_time' and 'content', into the raw feedparser entry keys
+    they are computed from. The result can be passed as the fields
+    parameter of feedparser.parse
+
+    >>> sorted(smart_fields(["title", "update_time"]))
+    ['id', 'title', 'updated_parsed']
+
+    Values that end up under a key we asked for are sanitized and have
+    their links resolved just like in a full parse, wherever they come
+    from. Atom content is copied into the summary, and an RSS link is the
+    href of the story's links
+
+    >>> atom = ('<feed xmlns="http://www.w3.org/2005/Atom" '
+    ...         'xml:base="http://example.com/b/"><entry>'
+    ...         '<content type="html">&lt;p onclick="evil()"&gt;hi&lt;/p&gt;'
+    ...         '&lt;script&gt;alert(1)&lt;/script&gt;'
+    ...         '&lt;a href="rel"&gt;r&lt;/a&gt;</content></entry></feed>')
+    >>> feedparser.parse(atom, fields=smart_fields(["summary"]))["entries"]
+    [{'summary': u'<p>hi</p><a href="http://example.com/b/rel">r</a>'}]
+    >>> rss = ('<rss version="2.0"><channel><item>'
+    ...        '<link>http://example.com/1</link></item></channel></rss>')
+    >>> feedparser.parse(rss, fields=["links"])["entries"][0]["links"][0]["href"]
+    u'http://example.com/1'
+
+    The microformats in a description or content are still read when only
+    the tags, links or xfn they end up in are asked for, so every key comes
+    out the same as in a full parse
+
+    >>> rss = ('<rss version="0.91"><channel><item><title>t</title>'
+    ...        '<category>caf\xc3\xa9</category><description>'
+    ...        '&lt;a rel="tag" href="http://example.com/tag/x"&gt;x&lt;/a&gt;'
+    ...        '&lt;a rel="enclosure" href="http://example.com/a.mp3"&gt;a&lt;/a&gt;'
+    ...        '&lt;a rel="friend" href="http://example.com/f"&gt;f&lt;/a&gt;'
+    ...        '</description></item></channel></rss>')
+    >>> full = feedparser.parse(rss)["entries"][0]
+    >>> sorted(full.keys())
+    ['links', 'summary', 'summary_detail', 'tags', 'title', 'title_detail', 'xfn']
+    >>> [key for key in ["tags", "categories", "links", "enclosures", "xfn",
+    ...                  "summary", "title"]
+    ...  if feedparser.parse(rss, fields=[key])["entries"][0].get(key) !=
+    ...     full.get(key)]
+    []
+
+    @param fields: a list of story keys or None
+    @return: a list of feedparser entry keys or None
+    """
+    if fields is None:
+        return None
+
+    raw_fields = []
+    for field in fields:
+        for raw_field in SMART_FIELD_SOURCES.get(field, [field]):
+            if raw_field not in raw_fields:
+                raw_fields.append(raw_field)
+
+    return raw_fields
+
+
+def smart_fingerprint_fields(raw_fields):
+    """
+    Adds the keys L{smart_fingerprint} works from to a list of raw
+    feedparser entry keys, so a story parsed with only some of its keys
+    still gets the fingerprint a full parse would give it. Returns the keys
+    to parse with and the keys to take back out of each story once it has
+    been fingerprinted, which are the ones only the fingerprint needed
+
+    >>> parse_fields, extra = smart_fingerprint_fields(["title", "link"])
+    >>> sorted(parse_fields)
+    ['content', 'feedburner_origlink', 'id', 'link', 'published', 'summary', 'title', 'updated']
+    >>> sorted(extra)
+    ['content', 'feedburner_origlink', 'published', 'summary', 'updated']
+
+    >>> rss = ('<rss version="2.0"><channel><item><title>t</title>'
+    ...        '<guid isPermaLink="false">tag:a,2011:1</guid>'
+    ...        '<description>d</description></item></channel></rss>')
+    >>> entry = feedparser.parse(rss, fields=parse_fields)["entries"][0]
+    >>> smart_fingerprint(entry) == smart_fingerprint(
+    ...     feedparser.parse(rss)["entries"][0])
+    True
+
+    @param raw_fields: a list of feedparser entry keys or None
+    @return: a list of feedparser entry keys and a list of keys to drop,
+        both None if raw_fields is None
+    """
+    if raw_fields is None:
+        return None, None
+
+    # the keys feedparser keeps for the ones asked for, an RDF item's id
+    # comes from its rdf:about and is kept whatever was asked for, so the
+    # id is never taken back out
+    kept = set(raw_fields)
+    kept.add("id")
+    for field in raw_fields:
+        for suffix in ("_detail", "_parsed"):
+            if field.endswith(suffix):
+                kept.add(field[:-len(suffix)])
+    if "link" in kept:
+        kept.update(["links", "id"])
+
+    parse_fields = list(raw_fields)
+    extra = []
+    for field in SMART_FIELD_SOURCES["fingerprint"]:
+        if field not in parse_fields:
+            parse_fields.append(field)
+        if field not in kept:
+            extra.append(field)
+    if "link" in extra and "links" not in kept:
+        extra.append("links")
+
+    return parse_fields, extra
+
+
+def smart_drop_keys(entry, keys):
+    """
+    Deletes keys from a raw feedparser entry along with the *_detail and
+    *_parsed keys that go with them
+
+    >>> entry = feedparser.FeedParserDict({"title": "t", "summary": "s",
+    ...                                    "summary_detail": {}})
+    >>> smart_drop_keys(entry, ["summary", "id"])
+    >>> entry
+    {'title': 't'}
+    """
+    for key in keys:
+        for name in (key, key + "_detail", key + "_parsed"):
+            if name in entry:
+                del entry[name]
+
+
 def smart_parse(url, etag=None, modified=None, agent=None, referrer=None,
                 handlers=[], request_headers={}, response_headers={},
-                encoding_func=None):
+                encoding_func=None, fields=None, lazy_content=False,
+                config=None, compact=False, lazy_wrap=False, known_ids=None,
+                story_filter=None):
     """
     This function takes the url and the general arguments accepted by
     feedparser.parse and then sanitizes the url that we accept to try to guess
@@ -793,10 +1434,55 @@ def smart_parse(url, etag=None, modified=None, agent=None, referrer=None,
     @param url: The url of the resource we wish to crawl, attempts to make smart
         guesses about escaping and protocol
     @type url: string
+    @param fields: (optional) a list of story keys we're interested in, any
+        other story elements are skipped while parsing which makes parsing
+        much cheaper. Normalized keys like 'update_time' and 'content' are
+        translated by L{smart_fields}. The keys the story's fingerprint is
+        made from are read too, see L{smart_fingerprint_fields}
+    @param lazy_content: (optional) if True html content is stored raw and
+        only has its relative links resolved and its markup sanitized the
+        first time it is read, so stories we throw away cost almost nothing
+    @param config: (optional) a feedparser.ParserConfig, lets feeds we trust
+        skip sanitizing and microformats while others get the full treatment
+    @type config: feedparser.ParserConfig
+    @param compact: (optional) if True the stories are L{SmartEntry} objects
+        holding only the normalized fields instead of SmartFeedParserDicts
+    @param lazy_wrap: (optional) if True nested elements of the result are
+        only wrapped in SmartFeedParserDicts as they're read, so we only pay
+        for what we use, see L{make_smart_object}
+    @param known_ids: (optional) a set of the ids and links of stories we
+        already have, or a function returning True for them. Those stories
+        are skipped as soon as their id or link has been read, without
+        sanitizing or date parsing the rest of them, and left out of the
+        result
+    @param story_filter: (optional) a L{SeenStories} or L{StoryBloomFilter},
+        only the stories it hasn't seen before are returned, and they're
+        remembered as seen
     @return: a SmartFeedParserDict
 
     >>> type(smart_parse('http://reddit.com/.rss')) #doctest: +ELLIPSIS
     <type 'instance'>
+
+    >>> result = smart_parse('http://reddit.com/.rss',
+    ...                      fields=["title", "link", "update_time"])
+    >>> "summary" in result["stories"][0]
+    False
+
+    >>> trusted = feedparser.ParserConfig(sanitize_html=0, parse_microformats=0)
+    >>> type(smart_parse('http://reddit.com/.rss', config=trusted))
+    <type 'instance'>
+
+    >>> result = smart_parse('http://reddit.com/.rss', compact=True)
+    >>> type(result["stories"][0])
+    <class 'smartrssparser.SmartEntry'>
+
+    >>> result = smart_parse('http://reddit.com/.rss', lazy_wrap=True)
+    >>> type(result["stories"][0])
+    <type 'instance'>
+
+    >>> seen = set([story["id"] for story in result["stories"]])
+    >>> len(smart_parse('http://reddit.com/.rss', known_ids=seen)["stories"])
+    0
     """
 
     #
@@ -809,15 +1495,176 @@ def smart_parse(url, etag=None, modified=None, agent=None, referrer=None,
     # Escape the url to make sure we can encode it
     url = unicode(url).encode("utf-8", errors='replace')
 
-    # Runs the feedparser.parse method and then wraps the result in our new custom fascade
-    return make_smart_object(
-        feedparser.parse(url, etag=etag, modified=modified, agent=agent,
-                         referrer=referrer, handlers=handlers,
-                         request_headers=request_headers,
-                         response_headers=response_headers), encoding_func=encoding_func)
+    # Stories are always fingerprinted, so the keys that takes are read
+    # whatever fields asks for
+    parse_fields, extra = smart_fingerprint_fields(smart_fields(fields))
+
+    fetch_time = time.time()
+    result = feedparser.parse(url, etag=etag, modified=modified, agent=agent,
+                              referrer=referrer, handlers=handlers,
+                              request_headers=request_headers,
+                              response_headers=response_headers,
+                              fields=parse_fields,
+                              lazy_content=lazy_content, config=config,
+                              known_ids=known_ids)
+
+    # Known stories come back as stubs, we've no use for them
+    if known_ids is not None:
+        result["entries"] = [entry for entry in result.get("entries", [])
+                             if not entry.get("known")]
+
+    # Fingerprint the stories once, here, so nothing has to work it out again
+    for entry in result.get("entries", []):
+        entry["fingerprint"] = smart_fingerprint(entry)
+
+    if story_filter is not None:
+        result["entries"] = story_filter.filter_new(result.get("entries", []))
+
+    if extra:
+        for entry in result.get("entries", []):
+            smart_drop_keys(entry, extra)
+
+    # Work the update times out now so they don't depend on when we read them
+    smart_normalize_update_times(result.get("entries", []), fetch_time)
+
+    # Swap the entries for compact ones before anything wraps them
+    if compact:
+        result["entries"] = [SmartEntry.from_story(entry)
+                             for entry in result.get("entries", [])]
+
+    # Wrap the result in our new custom fascade
+    return make_smart_object(result, encoding_func=encoding_func,
+                             lazy=lazy_wrap)
+
+
+class SmartEntryIterator:
+    """
+    Wraps the iterator returned by feedparser.iter_entries so that each
+    entry comes back as a SmartFeedParserDict, and the feed level data as
+    a SmartFeedParserDict under the feed attribute. Closing this iterator
+    closes the underlying connection.
+    """
 
+    def __init__(self, entry_iterator, encoding_func=None, compact=False,
+                 lazy_wrap=False, skip_known=False, story_filter=None,
+                 extra=None):
+        self.entry_iterator = entry_iterator
+        self.encoding_func = encoding_func
+        self.compact = compact
+        self.lazy_wrap = lazy_wrap
+        self.skip_known = skip_known
+        self.story_filter = story_filter
+        self.extra = extra
+        self.fetch_time = time.time()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while True:
+            entry = self.entry_iterator.next()
+            if self.skip_known and entry.get("known"):
+                continue
+            entry["fingerprint"] = smart_fingerprint(entry)
+            if (self.story_filter is None or
+                    self.story_filter.filter_new([entry])):
+                break
+        if self.extra:
+            smart_drop_keys(entry, self.extra)
+        smart_normalize_update_times([entry], self.fetch_time)
+
+        if self.compact:
+            return SmartEntry.from_story(entry)
+        return make_smart_object(entry, encoding_func=self.encoding_func,
+                                 lazy=self.lazy_wrap)
+
+    def close(self):
+        self.entry_iterator.close()
+
+    def __getattr__(self, name):
+        # bozo, status, headers, etc. come straight from feedparser
+        return getattr(self.entry_iterator, name)
+
+    @property
+    def feed(self):
+        return make_smart_object(self.entry_iterator.feed,
+                                 lazy=self.lazy_wrap)
+
+
+def smart_iter_entries(url, etag=None, modified=None, agent=None,
+                       referrer=None, handlers=[], request_headers={},
+                       response_headers={}, encoding_func=None, fields=None,
+                       lazy_content=False, config=None, compact=False,
+                       lazy_wrap=False, known_ids=None, story_filter=None):
+    """
+    A streaming counterpart to smart_parse. Instead of waiting for the whole
+    feed to be parsed this returns an iterator which yields each story as a
+    SmartFeedParserDict as soon as its closing tag has been read. This lets
+    us stop reading a feed as soon as we reach a story we've already seen,
+    closing the iterator aborts the parse and releases the connection.
+
+    Feed level data such as the title is available through the feed
+    attribute once the first story has been yielded.
+
+    >>> stories = smart_iter_entries('http://reddit.com/.rss')
+    >>> story = stories.next()
+    >>> title = stories.feed["title"]
+    >>> stories.close()
+
+    A feed the streaming parser gives up on partway through, like this one
+    with an html entity in a late story, is parsed again by the loose parser
+    and only the stories that haven't been yielded yet are yielded from that
+
+    >>> items = ["<item><title>%d</title><link>/%d</link></item>" % (n, n)
+    ...          for n in range(1000)]
+    >>> items[900] = "<item><title>nine&nbsp;hundred</title></item>"
+    >>> rss = '<rss version="2.0"><channel>%s</channel></rss>' % "".join(items)
+    >>> entries = feedparser.iter_entries(rss)
+    >>> first = entries.next()
+    >>> entries.bozo
+    0
+    >>> titles = [first["title"]] + [entry["title"] for entry in entries]
+    >>> entries.bozo
+    1
+    >>> titles == [entry["title"] for entry in feedparser.parse(rss)["entries"]]
+    True
+    >>> len(titles)
+    1000
 
-def smart_new_story_filter(stories_object, identifier, most_recent_identifier=""):
+    @param url: The url of the resource we wish to crawl, attempts to make smart
+        guesses about escaping and protocol
+    @type url: string
+    @param fields: (optional) a list of story keys, see L{smart_parse}
+    @param lazy_content: (optional) defer sanitizing, see L{smart_parse}
+    @param config: (optional) a feedparser.ParserConfig, see L{smart_parse}
+    @param compact: (optional) yield L{SmartEntry} stories, see L{smart_parse}
+    @param lazy_wrap: (optional) wrap nested elements as they're read, see
+        L{smart_parse}
+    @param known_ids: (optional) skip stories we already have, see
+        L{smart_parse}
+    @param story_filter: (optional) only yield stories it hasn't seen, see
+        L{smart_parse}
+    @return: a SmartEntryIterator
+    """
+    url = smart_url_protocol_guesser(url)
+    url = unicode(url).encode("utf-8", errors='replace')
+    parse_fields, extra = smart_fingerprint_fields(smart_fields(fields))
+
+    return SmartEntryIterator(
+        feedparser.iter_entries(url, etag=etag, modified=modified, agent=agent,
+                                referrer=referrer, handlers=handlers,
+                                request_headers=request_headers,
+                                response_headers=response_headers,
+                                fields=parse_fields,
+                                lazy_content=lazy_content, config=config,
+                                known_ids=known_ids),
+        encoding_func=encoding_func, compact=compact, lazy_wrap=lazy_wrap,
+        skip_known=known_ids is not None, story_filter=story_filter,
+        extra=extra)
+
+
+def smart_new_story_filter(stories_object, identifier, most_recent_identifier="",
+                           recent_identifiers=None):
     """
     This function handles the problem of determinig which stories or entries in
     an RSS feed are newer than stories that we already have (in a file, db,
@@ -845,6 +1692,10 @@ def smart_new_story_filter(stories_object, identifier, most_recent_identifier=""
         and our identifier as 'num' then we might pass this function
         '2' and this function would return [{'num': '1'}], which is
         a list of elements we haven not yet encountered.
+    @param recent_identifiers: (optional) the identifiers of the last few
+        stories we have, used instead of most_recent_identifier. The
+        elements before the first of them found in the list are returned, so
+        one edited or deleted story doesn't make us take the whole feed again.
 
     >>> stories_object = [{"title": "Apple"}, {"title": "Bannanna"}, {"title": "Grape"}]
     >>> most_recent_identifier = "Bannanna"
@@ -857,36 +1708,630 @@ def smart_new_story_filter(stories_object, identifier, most_recent_identifier=""
     >>> smart_new_story_filter(stories_object, "foo", "Bannanna")
     [{'title': 'Apple'}, {'title': 'Bannanna'}, {'title': 'Grape'}]
 
+    >>> smart_new_story_filter(stories_object, "title",
+    ...                        recent_identifiers=["Kiwi", "Grape"])
+    [{'title': 'Apple'}, {'title': 'Bannanna'}]
+
+    For a filter that copes with any reordering see L{SeenStories}.
     """
 
-    # Build a list of identifiers maintaining the original order
-    # If the key is we have chosen for the indentifier is missing for an element
-    # Then we use None as a place holder to maintain the correct mapping of this
-    # list to the list of elements that was passed in
+    if recent_identifiers is None:
+        recent_identifiers = [most_recent_identifier]
+
+    # Index each identifier by the position of the first element that has it,
+    # so finding the pivot is a single pass over the list however long it is
     all_none = True
+    first_index = {}
     identifier_list = []
-    for elm in stories_object:
+    for index, elm in enumerate(stories_object):
         if identifier in elm:
-            identifier_list.append(elm[identifier])
+            value = elm[identifier]
             all_none = False
+            try:
+                first_index.setdefault(value, index)
+            except TypeError:
+                # Unhashable identifiers (lists and the like) are looked up
+                # the slow way
+                identifier_list.append((value, index))
         else:
-            identifier_list.append(None)
+            # None stands in for a missing identifier, as it always has
+            first_index.setdefault(None, index)
 
     if all_none:
         warnings.warn("None of the stories_object elements had the key '%s'. The entire list will be returned unfiltered" % identifier)
 
-    # Get the index of the most_recent_identifier from the list of feed elements
-    if most_recent_identifier in identifier_list:
-        pivot_identifier_index = identifier_list.index(most_recent_identifier)
-
-    # If it isn't in the list then all of the elements must be new
-    else:
-        pivot_identifier_index = len(identifier_list)
+    # The pivot is the first element we already have, if none of them are in
+    # the list then all of the elements must be new
+    pivot_identifier_index = len(stories_object)
+    for recent in recent_identifiers:
+        try:
+            index = first_index.get(recent)
+        except TypeError:
+            index = None
+            for value, position in identifier_list:
+                if value == recent:
+                    index = position
+                    break
+        if index is not None and index < pivot_identifier_index:
+            pivot_identifier_index = index
 
     # Return a list of new elements
     return stories_object[0:pivot_identifier_index]
 
 
+# Query parameters that only say where a reader came from, which
+# smart_canonical_link drops along with any starting with one of
+# SMART_TRACKING_PREFIXES. Names are compared in lower case. Only names no
+# site uses for anything else belong here, parameters like sid or ncid pick
+# the article on some sites and dropping them would merge their stories
+SMART_TRACKING_PARAMETERS = frozenset(["fbclid", "gclid", "msclkid", "igshid"])
+SMART_TRACKING_PREFIXES = ("utm_", "mc_", "_hs")
+
+# Canonical links we've already worked out, feeds hand us the same links on
+# every poll
+_canonical_link_cache = feedparser.LRUCache(10000)
+
+_session_path_parameter = re.compile(r";jsessionid=[^/?#]*", re.I)
+
+
+def smart_canonical_link(url, tracking_parameters=None,
+                         tracking_prefixes=None, sort_query=True):
+    """
+    Returns a link in a canonical form, so the same article linked to in
+    different ways compares equal: the scheme and host are lowercased,
+    default ports, tracking parameters, a ;jsessionid in the path and the
+    fragment (unless it's a #! one) are dropped, the remaining query
+    parameters are sorted by name and an empty path becomes "/". Results
+    are cached, so canonicalizing the links we see on every poll costs a
+    dictionary lookup.
+
+    >>> smart_canonical_link(" HTTP://Example.COM:80#top ")
+    'http://example.com/'
+
+    >>> smart_canonical_link("http://a.com/x?utm_source=rss&b=2&a=1&fbclid=z")
+    'http://a.com/x?a=1&b=2'
+    >>> smart_canonical_link("http://User:PW@Example.COM:8080/x")
+    'http://User:PW@example.com:8080/x'
+
+    Parameters that some sites use to pick the article are kept, and so are
+    hashbang fragments, which are the article's path on sites that route in
+    the browser
+
+    >>> smart_canonical_link("http://slashdot.org/article.pl?sid=11/05/01/1234")
+    'http://slashdot.org/article.pl?sid=11/05/01/1234'
+    >>> smart_canonical_link("http://example.com/#!/story/1")
+    'http://example.com/#!/story/1'
+
+    @param url: a link
+    @param tracking_parameters: (optional) the query parameter names to drop,
+        defaults to L{SMART_TRACKING_PARAMETERS}
+    @param tracking_prefixes: (optional) drop query parameters whose names
+        start with one of these, defaults to L{SMART_TRACKING_PREFIXES}
+    @param sort_query: (optional) if False the query parameters are left in
+        the order they came in
+    @return: the canonical link, a string of the same type
+    """
+    if tracking_parameters is None:
+        tracking_parameters = SMART_TRACKING_PARAMETERS
+    if tracking_prefixes is None:
+        tracking_prefixes = SMART_TRACKING_PREFIXES
+
+    key = (url, tracking_parameters, tracking_prefixes, sort_query)
+    try:
+        return _canonical_link_cache[key]
+    except KeyError:
+        pass
+    except TypeError:
+        # Unhashable parameters, a list say, aren't cached
+        key = None
+
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url.strip())
+    scheme = scheme.lower()
+    # a user name and password are case sensitive, only the host isn't
+    userinfo, at, host = netloc.rpartition("@")
+    netloc = userinfo + at + host.lower()
+    if (scheme == "http" and netloc.endswith(":80")) or \
+            (scheme == "https" and netloc.endswith(":443")):
+        netloc = netloc.rsplit(":", 1)[0]
+    if netloc and not path:
+        path = "/"
+    path = _session_path_parameter.sub("", path)
+
+    if query:
+        tracking_prefixes = tuple(tracking_prefixes)
+        parameters = []
+        for parameter in query.split("&"):
+            name = parameter.split("=", 1)[0].lower()
+            if not parameter or name in tracking_parameters or \
+                    name.startswith(tracking_prefixes):
+                continue
+            parameters.append(parameter)
+        if sort_query:
+            parameters.sort(key=lambda parameter: parameter.split("=", 1)[0])
+        query = "&".join(parameters)
+
+    if not fragment.startswith("!"):
+        fragment = ""
+    canonical = urlparse.urlunsplit((scheme, netloc, path, query, fragment))
+    if key is not None:
+        _canonical_link_cache[key] = canonical
+    return canonical
+
+
+def smart_story_canonical_link(story):
+    """
+    Returns the canonical link of a story, see L{smart_canonical_link}.
+    Feedburner replaces the links in the feeds it serves with its own
+    (feeds.feedburner.com/~r/...) redirects and gives the original link as
+    feedburner:origLink, so that's used when it's there. Returns "" for a
+    story without a link.
+
+    >>> smart_story_canonical_link({
+    ...     'link': 'http://feeds.feedburner.com/~r/a/~3/x/story',
+    ...     'feedburner_origlink': 'http://a.com/story?utm_medium=feed'})
+    u'http://a.com/story'
+
+    @param story: a raw feedparser entry or a dictionary like it
+    @return: a unicode string
+    """
+    link = story.get("feedburner_origlink", None) or \
+        story.get("link", None)
+    if not link:
+        return u""
+    if isinstance(link, str):
+        link = link.decode("utf-8", "replace")
+
+    return smart_canonical_link(unicode(link))
+
+
+def smart_story_key(story):
+    """
+    Returns the key we remember a story by: its id, or failing that its
+    canonical link, or failing that a hash of its title, publication date
+    and the start of its content, which stays the same from one poll of the
+    feed to the next. Returns "" for a story with none of these.
+
+    >>> smart_story_key({'id': 'tag:a,2011:1', 'link': 'http://a/1'})
+    u'tag:a,2011:1'
+
+    >>> smart_story_key({'link': 'HTTP://A/1#comments'})
+    u'http://a/1'
+
+    >>> smart_story_key({'title': 'A', 'published': '2011-01-01'})
+    u'sha1:5e072481da9967e30bd657ac96e65e362d0c1a34'
+
+    @param story: a raw feedparser entry or a dictionary like it
+    @return: a unicode string
+    """
+    story_id = story.get("id", None)
+    if story_id:
+        if isinstance(story_id, str):
+            story_id = story_id.decode("utf-8", "replace")
+        return unicode(story_id)
+
+    link = smart_story_canonical_link(story)
+    if link:
+        return link
+
+    title = story.get("title", None) or ""
+    date = story.get("published", None) or story.get("updated", None) or ""
+
+    content = story.get("content", None) or story.get("summary", None) or ""
+    if isinstance(content, list):
+        content = content[0].get("value", "")
+    if isinstance(content, feedparser.LazyContent):
+        content = content.value()
+
+    if not title and not content:
+        return u""
+    if isinstance(title, str):
+        title = title.decode("utf-8", "replace")
+    if isinstance(content, str):
+        content = content.decode("utf-8", "replace")
+
+    text = u"%s\n%s" % (title, date)
+    if content:
+        text = u"%s\n%s" % (text, content[:256])
+    return u"sha1:" + hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def smart_fingerprint(story):
+    """
+    Returns a 64 bit integer that identifies a story from one poll to the
+    next, a hash of its L{smart_story_key}, or None if it doesn't have one.
+    smart_parse stores this in each story as story["fingerprint"] when the
+    feed is parsed, reading the keys it's made from whatever fields asks
+    for. It's signed so it fits a sqlite INTEGER, which keeps indexes and
+    seen sets small and comparisons cheap.
+
+    >>> smart_fingerprint({'id': 'tag:a,2011:1'})
+    2882403422481993415
+
+    >>> smart_fingerprint({}) is None
+    True
+
+    @param story: a raw feedparser entry or a dictionary like it
+    @return: an integer or None
+    """
+    key = smart_story_key(story)
+    if not key:
+        return None
+
+    digest = hashlib.sha1(key.encode("utf-8")).digest()
+    return struct.unpack(">q", digest[:8])[0]
+
+
+class SeenStories:
+    """
+    Remembers the stories we've already taken from our feeds, so each poll
+    only gives us the new ones however the feed reorders, edits or drops its
+    stories. Stories are remembered by their 64 bit fingerprint, see
+    L{smart_fingerprint}.
+
+    With a path the fingerprints live in a sqlite database there, which
+    survives restarts, can be shared between processes and holds millions
+    of them as the integer keys of a single table; without one they live in
+    a dict. A fingerprint is forgotten once it hasn't been seen for ttl
+    seconds.
+
+    >>> seen = SeenStories()
+    >>> stories = [{"id": "1"}, {"id": "2"}]
+    >>> seen.filter_new(stories)
+    [{'id': '1'}, {'id': '2'}]
+    >>> seen.filter_new([{"id": "3"}] + stories)
+    [{'id': '3'}]
+    >>> len(seen)
+    3
+
+    @param path: (optional) the sqlite database file to keep the
+        fingerprints in
+    @param ttl: (optional) how many seconds to remember a fingerprint for
+        after it was last seen, defaults to thirty days
+    @param expire_interval: (optional) filter_new forgets expired
+        fingerprints at most once every this many seconds
+    """
+
+    # sqlite won't take more than 999 parameters in one statement
+    batch_size = 500
+
+    def __init__(self, path=None, ttl=30 * 24 * 60 * 60,
+                 expire_interval=60 * 60):
+        self.path = path
+        self.ttl = ttl
+        self.expire_interval = expire_interval
+        self._memory = {}
+        self._db = None
+        self._pid = None
+        self._last_expired = 0
+
+    def _connect(self):
+        # sqlite connections can't be carried over into a forked process
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(self.path, timeout=30)
+            self._db.execute("CREATE TABLE IF NOT EXISTS seen_fingerprints "
+                             "(fingerprint INTEGER PRIMARY KEY, "
+                             "seen_at INTEGER)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS seen_at_index "
+                             "ON seen_fingerprints (seen_at)")
+            self._pid = os.getpid()
+        return self._db
+
+    def _known(self, fingerprints):
+        if self.path is None:
+            return set([fingerprint for fingerprint in fingerprints
+                        if fingerprint in self._memory])
+
+        db = self._connect()
+        known = set()
+        for start in range(0, len(fingerprints), self.batch_size):
+            batch = fingerprints[start:start + self.batch_size]
+            rows = db.execute("SELECT fingerprint FROM seen_fingerprints "
+                              "WHERE fingerprint IN (%s)" %
+                              ",".join(["?"] * len(batch)), batch)
+            known.update([row[0] for row in rows])
+        return known
+
+    def add(self, fingerprints, now=None):
+        """
+        Remembers these fingerprints as seen now
+
+        @param fingerprints: a list of L{smart_fingerprint}s
+        @param now: (optional) the time they were seen, defaults to now
+        """
+        if now is None:
+            now = time.time()
+        now = int(now)
+
+        if self.path is None:
+            for fingerprint in fingerprints:
+                self._memory[fingerprint] = now
+            return
+
+        db = self._connect()
+        db.executemany("INSERT OR REPLACE INTO seen_fingerprints "
+                       "(fingerprint, seen_at) VALUES (?, ?)",
+                       [(fingerprint, now) for fingerprint in fingerprints])
+        db.commit()
+
+    def filter_new(self, stories_object, now=None):
+        """
+        Returns the stories we haven't seen before, in their original order,
+        and remembers all of the stories as seen. Stories that are still in
+        the feed are remembered afresh, so they never expire while the feed
+        keeps them. Stories without a fingerprint are always new.
+
+        @param stories_object: a list of stories
+        @param now: (optional) the time of this poll, defaults to now
+        @return: a list of the new stories
+        """
+        if now is None:
+            now = time.time()
+
+        # smart_parse fingerprints every story, anything else we work out
+        fingerprints = []
+        for story in stories_object:
+            fingerprint = story.get("fingerprint", None)
+            if fingerprint is None:
+                fingerprint = smart_fingerprint(story)
+            fingerprints.append(fingerprint)
+
+        unique_fingerprints = list(set(fingerprints) - set([None]))
+        known = self._known(unique_fingerprints)
+
+        new_stories = []
+        for story, fingerprint in zip(stories_object, fingerprints):
+            if fingerprint is None or fingerprint not in known:
+                new_stories.append(story)
+                known.add(fingerprint)
+
+        self.add(unique_fingerprints, now)
+        if now - self._last_expired >= self.expire_interval:
+            self.expire(now)
+        return new_stories
+
+    def expire(self, now=None):
+        """
+        Forgets the fingerprints that haven't been seen for ttl seconds
+
+        @param now: (optional) defaults to now
+        """
+        if now is None:
+            now = time.time()
+        self._last_expired = now
+        cutoff = int(now - self.ttl)
+
+        if self.path is None:
+            for fingerprint, seen_at in self._memory.items():
+                if seen_at < cutoff:
+                    del self._memory[fingerprint]
+            return
+
+        db = self._connect()
+        db.execute("DELETE FROM seen_fingerprints WHERE seen_at < ?",
+                   (cutoff,))
+        db.commit()
+
+    def __contains__(self, fingerprint):
+        return bool(self._known([fingerprint]))
+
+    def __len__(self):
+        if self.path is None:
+            return len(self._memory)
+        return self._connect().execute(
+            "SELECT COUNT(*) FROM seen_fingerprints").fetchone()[0]
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def smart_story_link_key(story):
+    """
+    Returns the key stories are told apart by across feeds: the canonical
+    link, which is the same for an article however many feeds carry it, or
+    failing that L{smart_story_key}
+
+    >>> smart_story_link_key({'id': 'feed-a-17',
+    ...                       'link': 'http://a/1?utm_source=feed-a'})
+    u'http://a/1'
+
+    @param story: a story, raw feedparser entry or dictionary like them
+    @return: a unicode string
+    """
+    return smart_story_canonical_link(story) or smart_story_key(story)
+
+
+class StoryBloomFilter:
+    """
+    A fixed size Bloom filter of the stories seen across all of our feeds,
+    which answers "possibly seen" in microseconds before we go anywhere near
+    the database. It can say a story was seen when it wasn't (about
+    error_rate of the time) but never the other way around.
+
+    With a path the filter lives in a file that's mmap'd, so every crawler
+    process on the machine shares the one copy. Lookups read the mapped
+    pages without locking; adding keys takes an exclusive flock. The
+    settings of an existing file win over the ones given here.
+
+    The filter is split into generations of capacity keys each. When the
+    current generation is full the oldest one is cleared and takes its
+    place, so the filter remembers between (generations - 1) * capacity and
+    generations * capacity of the most recent keys and never fills up.
+
+    >>> bloom = StoryBloomFilter(capacity=1000)
+    >>> stories = [{"link": "http://a/1"}, {"link": "http://a/2"}]
+    >>> bloom.filter_new(stories)
+    [{'link': 'http://a/1'}, {'link': 'http://a/2'}]
+    >>> bloom.filter_new([{"link": "http://a/3"}] + stories)
+    [{'link': 'http://a/3'}]
+    >>> u"http://a/2" in bloom
+    True
+
+    @param path: (optional) the file to keep the filter in
+    @param capacity: (optional) how many keys a generation holds
+    @param error_rate: (optional) the false positive rate when full
+    @param generations: (optional) how many generations to keep
+    @param key_func: (optional) what to tell stories apart by, defaults to
+        L{smart_story_link_key}
+    """
+
+    magic = "SRBF"
+    # magic, version, bits and hashes per generation, generations, current
+    # generation, capacity, followed by a key count for each generation
+    header_format = "<4sIQIIIQ"
+    current_offset = struct.calcsize("<4sIQII")
+
+    def __init__(self, path=None, capacity=1000000, error_rate=0.001,
+                 generations=2, key_func=None):
+        self.path = path
+        self.key_func = key_func or smart_story_link_key
+
+        # Each generation gets its share of the error rate, since a lookup
+        # checks them all
+        bits = int(math.ceil(-capacity * math.log(error_rate / generations) /
+                             math.log(2) ** 2))
+        bits = (bits + 63) // 64 * 64
+        hashes = max(1, int(round(float(bits) / capacity * math.log(2))))
+        self._open(bits, hashes, generations, capacity)
+
+    def _open(self, bits, hashes, generations, capacity):
+        header_size = struct.calcsize(self.header_format)
+        if self.path is None:
+            self._file = None
+            self._mmap = mmap.mmap(-1, self._size(bits, generations))
+            self._write_header(bits, hashes, generations, capacity)
+        else:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+            self._file = os.fdopen(fd, "r+b")
+            self._lock()
+            try:
+                if os.fstat(fd).st_size < header_size:
+                    self._file.truncate(self._size(bits, generations))
+                    self._mmap = mmap.mmap(fd, 0)
+                    self._write_header(bits, hashes, generations, capacity)
+                else:
+                    self._mmap = mmap.mmap(fd, 0)
+            finally:
+                self._unlock()
+
+        (magic, version, self.bits, self.hashes, self.generations,
+         current, self.capacity) = struct.unpack_from(self.header_format,
+                                                      self._mmap)
+        if magic != self.magic or version != 1:
+            raise ValueError("%s is not a story bloom filter" % self.path)
+        self._counts_offset = header_size
+        self._bits_offset = header_size + 8 * self.generations
+        self._generation_size = self.bits // 8
+
+    def _size(self, bits, generations):
+        return (struct.calcsize(self.header_format) + 8 * generations +
+                bits // 8 * generations)
+
+    def _write_header(self, bits, hashes, generations, capacity):
+        struct.pack_into(self.header_format, self._mmap, 0, self.magic, 1,
+                         bits, hashes, generations, 0, capacity)
+
+    def _lock(self):
+        if self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+
+    def _unlock(self):
+        if self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def _positions(self, key):
+        # Double hashing, k positions from the two halves of one md5
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        h1, h2 = struct.unpack("<QQ", hashlib.md5(key).digest())
+        bits = self.bits
+        return [(h1 + i * h2) % bits for i in xrange(self.hashes)]
+
+    def _current(self):
+        return struct.unpack_from("<I", self._mmap, self.current_offset)[0]
+
+    def _contains_positions(self, positions):
+        mm = self._mmap
+        for generation in xrange(self.generations):
+            offset = self._bits_offset + generation * self._generation_size
+            for position in positions:
+                if not ord(mm[offset + (position >> 3)]) & (1 << (position & 7)):
+                    break
+            else:
+                return True
+        return False
+
+    def __contains__(self, key):
+        return self._contains_positions(self._positions(key))
+
+    def add(self, keys):
+        """
+        Adds these keys to the current generation, rotating generations as
+        they fill up
+
+        @param keys: a list of keys, see L{smart_story_link_key}
+        """
+        mm = self._mmap
+        self._lock()
+        try:
+            for key in keys:
+                current = self._current()
+                offset = self._bits_offset + current * self._generation_size
+                for position in self._positions(key):
+                    index = offset + (position >> 3)
+                    mm[index] = chr(ord(mm[index]) | (1 << (position & 7)))
+
+                count_offset = self._counts_offset + 8 * current
+                count = struct.unpack_from("<Q", mm, count_offset)[0] + 1
+                struct.pack_into("<Q", mm, count_offset, count)
+                if count >= self.capacity:
+                    self._rotate(current)
+        finally:
+            self._unlock()
+
+    def _rotate(self, current):
+        mm = self._mmap
+        current = (current + 1) % self.generations
+        offset = self._bits_offset + current * self._generation_size
+        mm[offset:offset + self._generation_size] = \
+            "\0" * self._generation_size
+        struct.pack_into("<Q", mm, self._counts_offset + 8 * current, 0)
+        struct.pack_into("<I", mm, self.current_offset, current)
+
+    def filter_new(self, stories_object):
+        """
+        Returns the stories that haven't possibly been seen before, in their
+        original order, and adds them to the filter. Stories without a key
+        are always new.
+
+        @param stories_object: a list of stories
+        @return: a list of the new stories
+        """
+        new_stories = []
+        new_keys = []
+        batch = set()
+        for story in stories_object:
+            key = self.key_func(story)
+            if not key:
+                new_stories.append(story)
+            elif key not in batch and key not in self:
+                new_stories.append(story)
+                new_keys.append(key)
+                batch.add(key)
+
+        self.add(new_keys)
+        return new_stories
+
+    def flush(self):
+        self._mmap.flush()
+
+    def close(self):
+        self._mmap.close()
+        if self._file is not None:
+            self._file.close()
+
+
 def smart_get_favicon_url(url):
     """
     This method tries various means to get a favicon (or better an apple-touch-icon)